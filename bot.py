@@ -1,18 +1,33 @@
 import asyncio
+import atexit
+import copy
 import logging
+import logging.handlers
 import os
+import queue
+import sys
 import re
+import json
+import time
+import difflib
+import functools
+import unicodedata
+import random
 import hashlib
+from collections import OrderedDict, deque, namedtuple
 from datetime import datetime, timedelta
-from typing import Dict, Optional, List, Set
-from telegram import Update, Bot, InlineKeyboardButton, InlineKeyboardMarkup, ChatMember
-from telegram.ext import Application, CommandHandler, ContextTypes, CallbackQueryHandler
+from typing import Any, AsyncIterator, Dict, Optional, List, Set
+from telegram import (Update, Bot, InlineKeyboardButton, InlineKeyboardMarkup, ChatMember,
+                      InlineQueryResultArticle, InputTextMessageContent)
+from telegram.ext import (Application, ApplicationHandlerStop, CommandHandler, ContextTypes, CallbackQueryHandler,
+                          InlineQueryHandler, TypeHandler)
 from telegram.constants import ParseMode
-from telegram.error import TelegramError
+from telegram.error import TelegramError, Forbidden, BadRequest, RetryAfter
 import pytz
 from dotenv import load_dotenv
 import discord
 import aiohttp
+from aiohttp import web
 
 load_dotenv()
 
@@ -21,6 +36,7 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
 CHANNEL_ID = os.getenv("CHANNEL_ID", "@GroowAGarden")
 CHANNEL_USERNAME = "GroowAGarden"
+ADMIN_IDS = {int(admin_id) for admin_id in os.getenv("ADMIN_IDS", "").split(",") if admin_id.strip()}
 
 SUPABASE_URL = os.getenv("SUPABASE_URL", "https://tcsmfiixhflzrxkrbslk.supabase.co")
 SUPABASE_API_KEY = os.getenv("SUPABASE_KEY", "")
@@ -28,6 +44,19 @@ SUPABASE_API_KEY = os.getenv("SUPABASE_KEY", "")
 AUTOSTOCKS_URL = f"{SUPABASE_URL}/rest/v1/user_autostocks"
 USERS_URL = f"{SUPABASE_URL}/rest/v1/users"
 
+# HTTP клиент Supabase
+HTTP_POOL_LIMIT = 50
+HTTP_POOL_LIMIT_PER_HOST = 20
+HTTP_KEEPALIVE_SECONDS = 30
+HTTP_DNS_CACHE_SECONDS = 300
+HTTP_TIMEOUT_SECONDS = 3
+HTTP_CONNECT_TIMEOUT_SECONDS = 1.5
+HTTP_RETRY_ATTEMPTS = 3
+HTTP_RETRY_BASE_DELAY = 0.2
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_SECONDS = 30
+SUPABASE_PAGE_SIZE = 500
+
 # Новые каналы Discord
 DISCORD_CHANNELS = {
     "stock": 1376781142291648653,  # seed-gear-stocks
@@ -40,106 +69,131 @@ CHECK_INTERVAL_MINUTES = 5
 CHECK_DELAY_SECONDS = 10
 RAREST_SEEDS = ["Crimson Thorn", "Zebrazinkle"]
 
+# Результаты доставки уведомлений
+DELIVERY_SENT = "sent"
+DELIVERY_PERMANENT = "permanent"
+DELIVERY_TRANSIENT = "transient"
+DELIVERY_SKIPPED = "skipped"
+DELIVERY_FILTERED = "filtered"
+SEND_RATE_PER_SECOND = 25
+BULK_QUEUE_LIMIT = 200
+
+BROADCAST_STATE_FILE = os.getenv("BROADCAST_STATE_FILE", "broadcast_state.json")
+BROADCAST_PROGRESS_SECONDS = 15
+
+# Закрепленные сообщения со стоком, которые редактируются при каждом рестоке
+LIVE_BOARD_CHATS = [chat.strip() for chat in os.getenv("LIVE_BOARD_CHATS", "").split(",") if chat.strip()]
+LIVE_BOARD_STATE_FILE = os.getenv("LIVE_BOARD_STATE_FILE", "live_board_state.json")
+
+# Журнал дедупликации переживает рестарты: уведомления и разбор сообщений не повторяются
+DEDUP_LEDGER_FILE = os.getenv("DEDUP_LEDGER_FILE", "dedup_ledger.json")
+DEDUP_TTL_SECONDS = 3600
+
+CATALOG_FILE = os.getenv("CATALOG_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "catalog.json"))
+CATALOG_WATCH_SECONDS = 30
+
+# Ограничение частоты запросов на пользователя (token bucket)
+THROTTLE_RATE_PER_SECOND = 1.0
+THROTTLE_BURST = 5
+THROTTLE_MAX_USERS = 10000
+TOGGLE_DEBOUNCE_SECONDS = 0.8
+# Нажатия на предметы дешевле команд (склеиваются), но тоже ограничены
+TOGGLE_RATE_PER_SECOND = 4.0
+TOGGLE_BURST = 20
+# Inline-клиент шлет запрос на каждое нажатие клавиши
+INLINE_RATE_PER_SECOND = 5.0
+INLINE_BURST = 30
+
+# Локальный read-only API со стоком; 0 - выключен
+STOCK_API_HOST = os.getenv("STOCK_API_HOST", "127.0.0.1")
+STOCK_API_PORT = int(os.getenv("STOCK_API_PORT", "0"))
+STOCK_API_KEEPALIVE_SECONDS = 15
+STOCK_API_SUBSCRIBER_QUEUE = 32
+PERMANENT_ERROR_MARKERS = ("chat not found", "user is deactivated", "bot was blocked", "bot was kicked", "peer_id_invalid")
+
 if not BOT_TOKEN or not DISCORD_TOKEN:
     raise ValueError("BOT_TOKEN и DISCORD_TOKEN должны быть установлены!")
 
 # ========== ЛОГИРОВАНИЕ ==========
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
-logger = logging.getLogger(__name__)
-logging.getLogger('discord').setLevel(logging.WARNING)
-logging.getLogger('httpx').setLevel(logging.WARNING)
+LOG_JSON = os.getenv("LOG_JSON", "1") != "0"
+LOG_SAMPLE_EVERY = int(os.getenv("LOG_SAMPLE_EVERY", "100"))
+LOG_FIELDS = ("item", "user_id", "chat_id", "latency_ms", "endpoint", "count", "channel")
 
-# ========== ДАННЫЕ ПРЕДМЕТОВ ==========
-SEEDS_DATA = {
-    "Carrot": {"emoji": "🥕", "price": "10"},
-    "Strawberry": {"emoji": "🍓", "price": "50"},
-    "Blueberry": {"emoji": "🫐", "price": "400"},
-    "Buttercup": {"emoji": "🌼", "price": "600"},
-    "Tomato": {"emoji": "🍅", "price": "800"},
-    "Corn": {"emoji": "🌽", "price": "1,300"},
-    "Daffodil": {"emoji": "🌼", "price": "1,000"},
-    "Watermelon": {"emoji": "🍉", "price": "2,500"},
-    "Pumpkin": {"emoji": "🎃", "price": "3,000"},
-    "Apple": {"emoji": "🍎", "price": "3,250"},
-    "Bamboo": {"emoji": "🎋", "price": "4,000"},
-    "Coconut": {"emoji": "🥥", "price": "6,000"},
-    "Cactus": {"emoji": "🌵", "price": "15,000"},
-    "Dragon Fruit": {"emoji": "🐉", "price": "50,000"},
-    "Mango": {"emoji": "🥭", "price": "100,000"},
-    "Grape": {"emoji": "🍇", "price": "850,000"},
-    "Mushroom": {"emoji": "🍄", "price": "150,000"},
-    "Pepper": {"emoji": "🌶️", "price": "1M"},
-    "Cacao": {"emoji": "🍫", "price": "2.5M"},
-    "Sunflower": {"emoji": "🌻", "price": "5.56M"},
-    "Beanstalk": {"emoji": "🪜", "price": "10M"},
-    "Ember Lily": {"emoji": "🔥", "price": "15M"},
-    "Sugar Apple": {"emoji": "🍎", "price": "25M"},
-    "Burning Bud": {"emoji": "🔥", "price": "40M"},
-    "Giant Pinecone": {"emoji": "🌲", "price": "55M"},
-    "Elder Strawberry": {"emoji": "🍓", "price": "70M"},
-    "Romanesco": {"emoji": "🥦", "price": "88M"},
-    "Crimson Thorn": {"emoji": "🌹", "price": "10B"},
-    "Zebrazinkle": {"emoji": "🦓", "price": "21B"},
-    "Broccoli": {"emoji": "🥦", "price": "600"},
-}
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": datetime.fromtimestamp(record.created, pytz.UTC).isoformat(timespec='milliseconds'),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for field in LOG_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                payload[field] = value
+        if record.exc_info:
+            payload["exc"] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False)
 
-GEAR_DATA = {
-    "Watering Can": {"emoji": "💧", "price": "50k"},
-    "Trowel": {"emoji": "🔨", "price": "100k"},
-    "Trading Ticket": {"emoji": "🎫", "price": "100k"},
-    "Recall Wrench": {"emoji": "🔧", "price": "150k"},
-    "Basic Sprinkler": {"emoji": "💦", "price": "25k"},
-    "Advanced Sprinkler": {"emoji": "💦", "price": "50k"},
-    "Medium Treat": {"emoji": "🍖", "price": "4M"},
-    "Medium Toy": {"emoji": "🎮", "price": "4M"},
-    "Godly Sprinkler": {"emoji": "✨", "price": "120k"},
-    "Magnifying Glass": {"emoji": "🔍", "price": "10M"},
-    "Master Sprinkler": {"emoji": "👑", "price": "10M"},
-    "Cleaning Spray": {"emoji": "🧼", "price": "15M"},
-    "Favorite Tool": {"emoji": "⭐", "price": "20M"},
-    "Harvest Tool": {"emoji": "✂️", "price": "30M"},
-    "Friendship Pot": {"emoji": "🪴", "price": "15M"},
-    "Level Up Lollipop": {"emoji": "🍭", "price": "10B"},
-    "Grandmaster Sprinkler": {"emoji": "🏆", "price": "1B"},
-    "Pet Name Reroller": {"emoji": "🎲", "price": "5M"},
-}
+class AsyncQueueHandler(logging.handlers.QueueHandler):
+    """Форматирование и запись в stdout делает поток QueueListener, а не event loop."""
+    
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
 
-EGGS_DATA = {
-    "Common Egg": {"emoji": "🥚", "price": "50k"},
-    "Uncommon Egg": {"emoji": "🟡", "price": "150k"},
-    "Rare Egg": {"emoji": "🔵", "price": "600k"},
-    "Legendary Egg": {"emoji": "💜", "price": "3M"},
-    "Mythical Egg": {"emoji": "🌈", "price": "8M"},
-    "Bug Egg": {"emoji": "🐛", "price": "50M"},
-    "Jungle Egg": {"emoji": "🦜", "price": "60M"},
-}
+class LogSampler:
+    """Пропускает в лог каждое N-е событие горячего пути; остальное идет в сводки цикла."""
+    
+    def __init__(self, every: int = LOG_SAMPLE_EVERY):
+        self.every = max(every, 1)
+        self.counters: Dict[str, int] = {}
+    
+    def should_log(self, key: str) -> bool:
+        count = self.counters.get(key, 0)
+        self.counters[key] = count + 1
+        return count % self.every == 0
 
-COSMETICS_DATA = {
-    "Beach Crate": {"emoji": "📦", "price": "?"},
-    "Summer Fun Crate": {"emoji": "📦", "price": "?"},
-    "Cooking Kit": {"emoji": "🍳", "price": "?"},
-    "Stone Lantern": {"emoji": "🏮", "price": "?"},
-    "Viney Beam": {"emoji": "🌿", "price": "?"},
-    "Hay Bale": {"emoji": "🌾", "price": "?"},
-    "Brick Stack": {"emoji": "🧱", "price": "?"},
-    "Torch": {"emoji": "🔥", "price": "?"},
-    "White Bench": {"emoji": "🪑", "price": "?"},
-}
+def setup_logging() -> logging.handlers.QueueListener:
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if LOG_JSON:
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers[:] = [AsyncQueueHandler(log_queue)]
+    root.setLevel(logging.INFO)
+    
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
 
-ITEMS_DATA = {}
-ITEMS_DATA.update({k: {**v, "category": "seed"} for k, v in SEEDS_DATA.items()})
-ITEMS_DATA.update({k: {**v, "category": "gear"} for k, v in GEAR_DATA.items()})
-ITEMS_DATA.update({k: {**v, "category": "egg"} for k, v in EGGS_DATA.items()})
-ITEMS_DATA.update({k: {**v, "category": "cosmetic"} for k, v in COSMETICS_DATA.items()})
+log_listener = setup_logging()
+log_sampler = LogSampler()
+logger = logging.getLogger(__name__)
+logging.getLogger('discord').setLevel(logging.WARNING)
+logging.getLogger('httpx').setLevel(logging.WARNING)
+
+# ========== ДАННЫЕ ПРЕДМЕТОВ ==========
+# Заполняются из CATALOG_FILE при старте и подменяются целиком при перезагрузке (apply_catalog)
+SEEDS_DATA: Dict[str, Dict] = {}
+GEAR_DATA: Dict[str, Dict] = {}
+EGGS_DATA: Dict[str, Dict] = {}
+COSMETICS_DATA: Dict[str, Dict] = {}
+ITEMS_DATA: Dict[str, Dict] = {}
+ITEM_ALIASES: Dict[str, str] = {}
 
 # ========== ГЛОБАЛЬНЫЕ ПЕРЕМЕННЫЕ ==========
 last_stock_state: Dict[str, int] = {}
-last_autostock_notification: Dict[str, datetime] = {}
 user_autostocks_cache: Dict[int, Set[str]] = {}
 subscription_cache: Dict[int, tuple] = {}
+inactive_users: Set[int] = set()
+user_item_last_sent: Dict[tuple, float] = {}
 cached_stock_data: Optional[Dict] = None
 cached_stock_time: Optional[datetime] = None
 cached_weather_data: Optional[str] = None
@@ -147,16 +201,32 @@ cached_weather_time: Optional[datetime] = None
 cached_cosmetics_data: Optional[Dict] = None
 cached_cosmetics_time: Optional[datetime] = None
 
+# Версия снапшота растет только при изменении содержимого
+stock_snapshot_version = 0
+stock_snapshot_time: Optional[str] = None
+stock_snapshot_key: Optional[str] = None
+cosmetics_snapshot_version = 0
+cosmetics_snapshot_time: Optional[str] = None
+
 NAME_TO_ID: Dict[str, str] = {}
 ID_TO_NAME: Dict[str, str] = {}
+ITEM_LABELS: Dict[str, str] = {}
+ITEM_NOTIFICATION_PARTS: Dict[str, tuple] = {}
+
+SEED_ITEMS_LIST: List[tuple] = []
+GEAR_ITEMS_LIST: List[tuple] = []
+EGG_ITEMS_LIST: List[tuple] = []
+
+# Фильтры подписки хранятся в строке user_autostocks
+FILTER_FIELDS = ("min_quantity", "quiet_start", "quiet_end", "timezone", "cooldown_minutes")
+DEFAULT_TIMEZONE = "Europe/Moscow"
+MAX_COOLDOWN_MINUTES = 24 * 60
 
-SEED_ITEMS_LIST = [(name, info) for name, info in sorted(ITEMS_DATA.items()) if info['category'] == 'seed']
-GEAR_ITEMS_LIST = [(name, info) for name, info in sorted(ITEMS_DATA.items()) if info['category'] == 'gear']
-EGG_ITEMS_LIST = [(name, info) for name, info in sorted(ITEMS_DATA.items()) if info['category'] == 'egg']
+SEARCH_RESULTS_LIMIT = 10
+TRACK_RESULTS_LIMIT = 5
 
 telegram_app: Optional[Application] = None
 discord_client: Optional[discord.Client] = None
-http_session: Optional[aiohttp.ClientSession] = None
 
 # ========== УТИЛИТЫ ==========
 def get_moscow_time() -> datetime:
@@ -185,16 +255,217 @@ def calculate_sleep_time() -> float:
     now = get_moscow_time()
     return max((next_check - now).total_seconds(), 0)
 
-def build_item_id_mappings():
-    global NAME_TO_ID, ID_TO_NAME
-    for item_name in ITEMS_DATA.keys():
-        hash_obj = hashlib.sha1(item_name.encode('utf-8'))
-        hash_hex = hash_obj.hexdigest()[:8]
-        category = ITEMS_DATA[item_name]['category']
-        safe_id = f"t_{category}_{hash_hex}"
-        NAME_TO_ID[item_name] = safe_id
-        ID_TO_NAME[safe_id] = item_name
-    logger.info(f"✅ Построены маппинги: {len(NAME_TO_ID)} предметов")
+def load_json_state(path: str, default):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+    except Exception as e:
+        logger.error(f"❌ Состояние {path}: {e}")
+        return default
+
+def save_json_state(path: str, data):
+    # Атомарная запись: рестарт посреди записи не оставит битый файл
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        logger.error(f"❌ Состояние {path}: {e}")
+
+def render_notification_parts(item_name: str, emoji: str, price: str) -> tuple:
+    return f"🔔 *АВТОСТОК*\n\n{emoji} *{item_name}*\n📦 x", f"\n💰 {price} ¢\n\n🕒 "
+
+def build_autostock_message(item_name: str, count: int, timestamp: str) -> str:
+    head, tail = ITEM_NOTIFICATION_PARTS.get(item_name) or render_notification_parts(item_name, "📦", "?")
+    return f"{head}{count}{tail}{timestamp}"
+
+def normalize_item_name(text: str) -> str:
+    """Регистр, диакритика и пунктуация не влияют на поиск: 'Zébra-zinkle' -> 'zebra zinkle'."""
+    decomposed = unicodedata.normalize('NFKD', text)
+    stripped = "".join(ch for ch in decomposed if not unicodedata.combining(ch))
+    return " ".join(re.sub(r'[^\w]+', ' ', stripped.casefold()).split())
+
+class ItemSearchIndex:
+    """Префиксный индекс имен предметов; строится один раз, поиск - один dict lookup."""
+    
+    RANK_EXACT, RANK_PREFIX, RANK_WORD, RANK_FUZZY = range(4)
+    
+    def __init__(self, items: Dict[str, Dict]):
+        self.by_normalized: Dict[str, str] = {}
+        ranked: Dict[str, Dict[str, int]] = {}
+        for item_name in items:
+            normalized = normalize_item_name(item_name)
+            self.by_normalized[normalized] = item_name
+            for end in range(1, len(normalized) + 1):
+                rank = self.RANK_EXACT if end == len(normalized) else self.RANK_PREFIX
+                self.add(ranked, normalized[:end], item_name, rank)
+            words = normalized.split()
+            for position in range(1, len(words)):
+                tail = " ".join(words[position:])
+                for end in range(1, len(tail) + 1):
+                    self.add(ranked, tail[:end], item_name, self.RANK_WORD)
+        
+        self.prefixes: Dict[str, List[str]] = {
+            prefix: [name for name, _ in sorted(names.items(), key=lambda entry: (entry[1], entry[0]))]
+            for prefix, names in ranked.items()
+        }
+    
+    @staticmethod
+    def add(ranked: Dict[str, Dict[str, int]], prefix: str, item_name: str, rank: int):
+        names = ranked.setdefault(prefix, {})
+        names[item_name] = min(rank, names.get(item_name, rank))
+    
+    def search(self, query: str, limit: int = SEARCH_RESULTS_LIMIT) -> List[str]:
+        normalized = normalize_item_name(query)
+        if not normalized:
+            return []
+        matches = self.prefixes.get(normalized)
+        if matches:
+            return matches[:limit]
+        close = difflib.get_close_matches(normalized, list(self.by_normalized), n=limit, cutoff=0.6)
+        return [self.by_normalized[name] for name in close]
+    
+    def resolve(self, query: str) -> Optional[str]:
+        return self.by_normalized.get(normalize_item_name(query))
+
+item_search_index: Optional[ItemSearchIndex] = None
+
+_stock_quantities: tuple = (None, {})
+
+def get_stock_quantities() -> Dict[str, int]:
+    """Количество каждого предмета в последнем снапшоте стока, без запроса к Discord."""
+    global _stock_quantities
+    version, quantities = _stock_quantities
+    if version != stock_snapshot_version:
+        quantities = {}
+        for category in ['seeds', 'gear', 'eggs']:
+            for item_name, quantity in (cached_stock_data or {}).get(category, []):
+                quantities[item_name] = quantity
+        _stock_quantities = (stock_snapshot_version, quantities)
+    return quantities
+
+def format_item_status(item_name: str) -> str:
+    quantity = get_stock_quantities().get(item_name)
+    price = ITEMS_DATA.get(item_name, {}).get('price', '?')
+    stock = f"в стоке x{quantity}" if quantity else "нет в стоке"
+    return f"💰 {price} ¢ · {stock}"
+
+# ========== КАТАЛОГ ==========
+CATALOG_SECTIONS = (("seeds", "seed"), ("gear", "gear"), ("eggs", "egg"), ("cosmetics", "cosmetic"))
+catalog_mtime: Optional[float] = None
+# mtime битого файла: watcher не перечитывает его, пока файл снова не изменится
+catalog_failed_mtime: Optional[float] = None
+unknown_item_names: Dict[str, int] = {}
+
+def make_item_id(item_name: str, category: str) -> str:
+    hash_hex = hashlib.sha1(item_name.encode('utf-8')).hexdigest()[:8]
+    return f"t_{category}_{hash_hex}"
+
+def load_catalog_file(path: str) -> Dict:
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def build_catalog(raw: Dict) -> Dict[str, Any]:
+    """Строит каталог и все производные индексы. Не трогает глобальное состояние, можно вызывать из потока."""
+    tables: Dict[str, Dict] = {}
+    items: Dict[str, Dict] = {}
+    for section, category in CATALOG_SECTIONS:
+        entries = raw.get(section)
+        if not isinstance(entries, dict):
+            raise ValueError(f"нет раздела '{section}'")
+        table = {}
+        for item_name, item_info in entries.items():
+            if not isinstance(item_info, dict) or "emoji" not in item_info or "price" not in item_info:
+                raise ValueError(f"некорректная запись '{item_name}'")
+            table[item_name] = {"emoji": item_info["emoji"], "price": str(item_info["price"])}
+            items[item_name] = {**table[item_name], "category": category}
+        tables[section] = table
+    
+    aliases = {normalize_item_name(item_name): item_name for item_name in items}
+    for alias, item_name in raw.get("aliases", {}).items():
+        if item_name not in items:
+            raise ValueError(f"алиас '{alias}' ссылается на неизвестный предмет '{item_name}'")
+        aliases[normalize_item_name(alias)] = item_name
+    
+    name_to_id = {item_name: make_item_id(item_name, info['category']) for item_name, info in items.items()}
+    by_category = lambda category: [(name, info) for name, info in sorted(items.items()) if info['category'] == category]
+    
+    return {
+        "tables": tables,
+        "items": items,
+        "aliases": aliases,
+        "name_to_id": name_to_id,
+        "id_to_name": {safe_id: item_name for item_name, safe_id in name_to_id.items()},
+        "seed_list": by_category('seed'),
+        "gear_list": by_category('gear'),
+        "egg_list": by_category('egg'),
+        "labels": {item_name: f"{info['emoji']} {item_name}" for item_name, info in items.items()},
+        "notification_parts": {
+            item_name: render_notification_parts(item_name, info['emoji'], info['price']) for item_name, info in items.items()
+        },
+        "search_index": ItemSearchIndex({name: info for name, info in items.items() if info['category'] != 'cosmetic'}),
+    }
+
+def apply_catalog(catalog: Dict[str, Any]):
+    """Подменяет все индексы без await между присваиваниями: хендлеры видят либо старый каталог, либо новый."""
+    global SEEDS_DATA, GEAR_DATA, EGGS_DATA, COSMETICS_DATA, ITEMS_DATA, ITEM_ALIASES
+    global NAME_TO_ID, ID_TO_NAME, SEED_ITEMS_LIST, GEAR_ITEMS_LIST, EGG_ITEMS_LIST
+    global ITEM_LABELS, ITEM_NOTIFICATION_PARTS, item_search_index
+    tables = catalog["tables"]
+    SEEDS_DATA, GEAR_DATA, EGGS_DATA, COSMETICS_DATA = tables["seeds"], tables["gear"], tables["eggs"], tables["cosmetics"]
+    ITEMS_DATA, ITEM_ALIASES = catalog["items"], catalog["aliases"]
+    NAME_TO_ID, ID_TO_NAME = catalog["name_to_id"], catalog["id_to_name"]
+    SEED_ITEMS_LIST, GEAR_ITEMS_LIST, EGG_ITEMS_LIST = catalog["seed_list"], catalog["gear_list"], catalog["egg_list"]
+    ITEM_LABELS, ITEM_NOTIFICATION_PARTS = catalog["labels"], catalog["notification_parts"]
+    item_search_index = catalog["search_index"]
+    
+    for item_name in [name for name in unknown_item_names if normalize_item_name(name) in ITEM_ALIASES]:
+        del unknown_item_names[item_name]
+    logger.info(f"✅ Каталог: {len(ITEMS_DATA)} предметов, {len(item_search_index.prefixes)} префиксов")
+
+async def reload_catalog(reason: str) -> tuple:
+    global catalog_mtime, catalog_failed_mtime
+    mtime = None
+    try:
+        mtime = os.path.getmtime(CATALOG_FILE)
+        raw = await asyncio.to_thread(load_catalog_file, CATALOG_FILE)
+        catalog = await asyncio.to_thread(build_catalog, raw)
+    except Exception as e:
+        catalog_failed_mtime = mtime
+        logger.error(f"❌ Каталог ({reason}): {e}")
+        return False, str(e)
+    
+    apply_catalog(catalog)
+    catalog_mtime = mtime
+    catalog_failed_mtime = None
+    # Рендеры и разобранные сообщения зависят от каталога
+    parser.render_cache.clear()
+    dedup_ledger.parsed.clear()
+    dedup_ledger.dirty = True
+    logger.info(f"🔄 Каталог перезагружен: {reason}")
+    return True, f"{len(ITEMS_DATA)} предметов"
+
+async def watch_catalog_file():
+    while True:
+        await asyncio.sleep(CATALOG_WATCH_SECONDS)
+        try:
+            mtime = os.path.getmtime(CATALOG_FILE)
+        except OSError:
+            continue
+        if mtime != catalog_mtime and mtime != catalog_failed_mtime:
+            await reload_catalog("файл изменен")
+
+def canonical_item_name(item_name: str) -> str:
+    canonical = ITEM_ALIASES.get(normalize_item_name(item_name))
+    if canonical:
+        return canonical
+    if item_name not in unknown_item_names:
+        logger.warning(f"🆕 Неизвестный предмет: {item_name}", extra={"item": item_name})
+    unknown_item_names[item_name] = unknown_item_names.get(item_name, 0) + 1
+    return item_name
 
 async def check_subscription(bot: Bot, user_id: int) -> bool:
     if user_id in subscription_cache:
@@ -210,35 +481,293 @@ async def check_subscription(bot: Bot, user_id: int) -> bool:
     except:
         return True
 
+def classify_send_error(error: Exception) -> str:
+    if isinstance(error, Forbidden):
+        return DELIVERY_PERMANENT
+    if isinstance(error, BadRequest) and any(marker in str(error).lower() for marker in PERMANENT_ERROR_MARKERS):
+        return DELIVERY_PERMANENT
+    return DELIVERY_TRANSIENT
+
 def get_subscription_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("📢 Подписаться", url=f"https://t.me/{CHANNEL_USERNAME}")],
         [InlineKeyboardButton("✅ Я подписался", callback_data="check_sub")]
     ])
 
+# ========== ДЕДУПЛИКАЦИЯ ==========
+class DedupLedger:
+    """Локальный журнал с TTL: отправленные уведомления и уже разобранные сообщения Discord."""
+    
+    def __init__(self, path: str = DEDUP_LEDGER_FILE, ttl: int = DEDUP_TTL_SECONDS):
+        self.path = path
+        self.ttl = ttl
+        state = load_json_state(path, {})
+        self.notified: Dict[str, float] = state.get("notified", {})
+        self.parsed: Dict[str, Dict] = state.get("parsed", {})
+        self.dirty = False
+        self.prune()
+    
+    def prune(self):
+        now = time.time()
+        for key in [key for key, expires_at in self.notified.items() if expires_at <= now]:
+            del self.notified[key]
+            self.dirty = True
+        for key in [key for key, entry in self.parsed.items() if entry["expires_at"] <= now]:
+            del self.parsed[key]
+            self.dirty = True
+    
+    def was_notified(self, key: str) -> bool:
+        expires_at = self.notified.get(key)
+        return expires_at is not None and expires_at > time.time()
+    
+    def mark_notified(self, key: str):
+        self.notified[key] = time.time() + self.ttl
+        self.dirty = True
+    
+    def get_parsed(self, message_key: str) -> Optional[Dict]:
+        entry = self.parsed.get(message_key)
+        if entry is None or entry["expires_at"] <= time.time():
+            return None
+        # JSON хранит кортежи (название, количество) как списки
+        return {category: [tuple(item) for item in items] for category, items in entry["result"].items()}
+    
+    def put_parsed(self, message_key: str, result: Dict):
+        self.parsed[message_key] = {"result": result, "expires_at": time.time() + self.ttl}
+        self.dirty = True
+    
+    def flush(self):
+        if not self.dirty:
+            return
+        self.prune()
+        save_json_state(self.path, {"notified": self.notified, "parsed": self.parsed})
+        self.dirty = False
+
+dedup_ledger = DedupLedger()
+
+def mark_notified_now(key: str):
+    """Отмечает уведомление и сразу пишет журнал на диск (повторная отметка ничего не пишет)."""
+    if dedup_ledger.was_notified(key):
+        return
+    dedup_ledger.mark_notified(key)
+    dedup_ledger.flush()
+
+def discord_message_key(msg) -> str:
+    edited = msg.edited_at or msg.created_at
+    return f"{msg.id}:{edited.timestamp():.0f}"
+
+def snapshot_content_key(sources: List[str], stock_data: Dict) -> str:
+    payload = json.dumps({"sources": sorted(sources), "stock": stock_data}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+# ========== HTTP КЛИЕНТ ==========
+HTTPResult = namedtuple("HTTPResult", ["status", "data", "headers"])
+
+class CircuitOpenError(Exception):
+    """Бэкенд помечен как нездоровый, запрос отклонен без сетевого вызова."""
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = BREAKER_FAILURE_THRESHOLD, reset_timeout: float = BREAKER_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.half_open_probe = False
+    
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+    
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self.half_open_probe:
+            # Пропускаем ровно один пробный запрос
+            self.half_open_probe = True
+            return True
+        return False
+    
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info("✅ Supabase снова доступен, breaker закрыт")
+        self.failures = 0
+        self.opened_at = None
+        self.half_open_probe = False
+    
+    def record_failure(self):
+        self.failures += 1
+        if self.half_open_probe or self.failures >= self.failure_threshold:
+            if self.opened_at is None or self.half_open_probe:
+                logger.warning(f"⚠️ Supabase недоступен, breaker открыт на {self.reset_timeout}с")
+            self.opened_at = time.monotonic()
+            self.half_open_probe = False
+    
+    def release_probe(self):
+        """Пробный запрос прерван без ответа (отмена): следующий вызов снова может стать пробой."""
+        self.half_open_probe = False
+
+class HTTPClient:
+    IDEMPOTENT_METHODS = {"GET", "HEAD"}
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+    
+    def __init__(self):
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.timeout = aiohttp.ClientTimeout(total=HTTP_TIMEOUT_SECONDS, sock_connect=HTTP_CONNECT_TIMEOUT_SECONDS)
+        self.breaker = CircuitBreaker()
+        self.latency_stats: Dict[str, Dict[str, float]] = {}
+    
+    async def get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=HTTP_POOL_LIMIT,
+                limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+                keepalive_timeout=HTTP_KEEPALIVE_SECONDS,
+                ttl_dns_cache=HTTP_DNS_CACHE_SECONDS,
+                use_dns_cache=True,
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+    
+    def record_latency(self, endpoint: str, elapsed: float, ok: bool):
+        stats = self.latency_stats.setdefault(endpoint, {"count": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0})
+        elapsed_ms = elapsed * 1000
+        stats["count"] += 1
+        stats["total_ms"] += elapsed_ms
+        stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+        if not ok:
+            stats["errors"] += 1
+    
+    def format_latency_stats(self) -> str:
+        parts = []
+        for endpoint, stats in sorted(self.latency_stats.items()):
+            avg = stats["total_ms"] / stats["count"] if stats["count"] else 0
+            parts.append(f"{endpoint}: n={stats['count']} avg={avg:.0f}ms max={stats['max_ms']:.0f}ms err={stats['errors']}")
+        return "; ".join(parts)
+    
+    async def request(self, method: str, url: str, endpoint: str, **kwargs) -> HTTPResult:
+        """Выполняет запрос через общий пул; идемпотентные запросы повторяются с jitter."""
+        method = method.upper()
+        attempts = HTTP_RETRY_ATTEMPTS if method in self.IDEMPOTENT_METHODS else 1
+        
+        for attempt in range(1, attempts + 1):
+            if not self.breaker.allow():
+                raise CircuitOpenError(endpoint)
+            
+            started = time.monotonic()
+            try:
+                session = await self.get_session()
+                async with session.request(method, url, **kwargs) as response:
+                    data: Any = None
+                    if response.status == 200 and response.content_type == "application/json":
+                        data = await response.json()
+                    result = HTTPResult(response.status, data, response.headers)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.record_latency(endpoint, time.monotonic() - started, False)
+                self.breaker.record_failure()
+                if attempt >= attempts:
+                    raise
+                logger.warning(f"⚠️ {endpoint}: {type(e).__name__}, повтор {attempt}/{attempts - 1}")
+            except Exception:
+                # Например, битый JSON: считаем сбоем, иначе проба half-open зависнет навсегда
+                self.record_latency(endpoint, time.monotonic() - started, False)
+                self.breaker.record_failure()
+                raise
+            except BaseException:
+                # Отмена ничего не говорит о здоровье Supabase, но пробу нужно освободить
+                self.breaker.release_probe()
+                raise
+            else:
+                server_error = result.status in self.RETRY_STATUSES
+                self.record_latency(endpoint, time.monotonic() - started, not server_error)
+                if not server_error:
+                    self.breaker.record_success()
+                    return result
+                self.breaker.record_failure()
+                if attempt >= attempts:
+                    return result
+                logger.warning(f"⚠️ {endpoint}: HTTP {result.status}, повтор {attempt}/{attempts - 1}")
+            
+            # Полный jitter: случайная задержка в пределах экспоненциального окна
+            await asyncio.sleep(random.uniform(0, HTTP_RETRY_BASE_DELAY * (2 ** (attempt - 1))))
+        
+        raise RuntimeError("unreachable")
+    
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+
+http_client = HTTPClient()
+
 # ========== БАЗА ДАННЫХ ==========
 class SupabaseDB:
-    def __init__(self):
+    def __init__(self, client: Optional[HTTPClient] = None):
+        self.http = client or http_client
         self.headers = {
             "apikey": SUPABASE_API_KEY,
             "Authorization": f"Bearer {SUPABASE_API_KEY}",
             "Content-Type": "application/json"
         }
     
-    async def get_session(self) -> aiohttp.ClientSession:
-        global http_session
-        if http_session is None or http_session.closed:
-            http_session = aiohttp.ClientSession()
-        return http_session
-    
     async def save_user(self, user_id: int, username: str = None, first_name: str = None):
         try:
-            session = await self.get_session()
-            data = {"user_id": user_id, "username": username, "first_name": first_name, "last_seen": datetime.now(pytz.UTC).isoformat()}
+            data = {"user_id": user_id, "username": username, "first_name": first_name, "last_seen": datetime.now(pytz.UTC).isoformat(), "is_active": True}
             headers = {**self.headers, "Prefer": "resolution=merge-duplicates"}
-            async with session.post(USERS_URL, json=data, headers=headers, timeout=aiohttp.ClientTimeout(total=3)) as response:
-                return response.status in [200, 201]
-        except:
+            result = await self.http.request("POST", USERS_URL, "users.upsert", json=data, headers=headers)
+            return result.status in [200, 201]
+        except Exception as e:
+            logger.error(f"❌ Пользователь {user_id}: {e}")
+            return False
+    
+    async def iter_pages(self, url: str, endpoint: str, params: Dict[str, str], key: str,
+                         page_size: int = SUPABASE_PAGE_SIZE, after=None) -> AsyncIterator[List[Dict]]:
+        """Keyset-пагинация PostgREST: страницы по `key` по возрастанию, без OFFSET."""
+        last_key = after
+        while True:
+            page_params = {**params, "order": f"{key}.asc", "limit": str(page_size)}
+            if last_key is not None:
+                page_params[key] = f"gt.{last_key}"
+            result = await self.http.request("GET", url, endpoint, headers=self.headers, params=page_params)
+            if result.status != 200 or result.data is None:
+                raise RuntimeError(f"{endpoint}: HTTP {result.status}")
+            rows = result.data
+            if rows:
+                yield rows
+            if len(rows) < page_size:
+                return
+            last_key = rows[-1][key]
+    
+    async def count_rows(self, url: str, endpoint: str, params: Dict[str, str]) -> Optional[int]:
+        headers = {**self.headers, "Prefer": "count=exact"}
+        result = await self.http.request("HEAD", url, endpoint, headers=headers, params=params)
+        content_range = result.headers.get("Content-Range", "")
+        total = content_range.rsplit("/", 1)[-1]
+        return int(total) if total.isdigit() else None
+    
+    async def set_user_active(self, user_id: int, active: bool) -> bool:
+        """Помечает пользователя и его автостоки активными/неактивными для рассылки."""
+        try:
+            user_result = await self.http.request("PATCH", USERS_URL, "users.set_active", json={"is_active": active},
+                                                  headers=self.headers, params={"user_id": f"eq.{user_id}"})
+        except Exception as e:
+            logger.error(f"❌ Статус {user_id}: {e}")
+            return False
+        autostocks_ok = await self.set_autostocks_active(user_id, active)
+        return user_result.status in [200, 204] and autostocks_ok
+    
+    async def set_autostocks_active(self, user_id: int, active: bool) -> bool:
+        """Трогает только строки с противоположным статусом, поэтому у активных пользователей ничего не меняется."""
+        try:
+            # NULL читатели считают активным (not.is.false), поэтому при отключении его тоже нужно захватить
+            params = {"user_id": f"eq.{user_id}", "is_active": "is.false" if active else "not.is.false"}
+            result = await self.http.request("PATCH", AUTOSTOCKS_URL, "autostocks.set_active", json={"is_active": active},
+                                             headers=self.headers, params=params)
+            return result.status in [200, 204]
+        except Exception as e:
+            logger.error(f"❌ Статус автостоков {user_id}: {e}")
             return False
     
     async def load_user_autostocks(self, user_id: int) -> Set[str]:
@@ -246,68 +775,252 @@ class SupabaseDB:
             return user_autostocks_cache[user_id].copy()
         
         try:
-            session = await self.get_session()
+            items_set: Set[str] = set()
             params = {"user_id": f"eq.{user_id}", "select": "item_name"}
-            async with session.get(AUTOSTOCKS_URL, headers=self.headers, params=params, timeout=aiohttp.ClientTimeout(total=3)) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    items_set = {item['item_name'] for item in data}
-                    user_autostocks_cache[user_id] = items_set
-                    return items_set
-                return set()
+            async for rows in self.iter_pages(AUTOSTOCKS_URL, "autostocks.by_user", params, "item_name"):
+                items_set.update(item['item_name'] for item in rows)
+            user_autostocks_cache[user_id] = items_set
+            return items_set
         except Exception as e:
             logger.error(f"❌ Загрузка: {e}")
             return user_autostocks_cache.get(user_id, set()).copy()
     
     async def save_user_autostock(self, user_id: int, item_name: str) -> bool:
         try:
-            session = await self.get_session()
             data = {"user_id": user_id, "item_name": item_name}
             headers = {**self.headers, "Prefer": "resolution=merge-duplicates"}
-            async with session.post(AUTOSTOCKS_URL, json=data, headers=headers, timeout=aiohttp.ClientTimeout(total=3)) as response:
-                success = response.status in [200, 201]
-                if success:
-                    if user_id not in user_autostocks_cache:
-                        user_autostocks_cache[user_id] = set()
-                    user_autostocks_cache[user_id].add(item_name)
-                    logger.info(f"✅ Добавлен: {user_id} -> {item_name}")
-                return success
+            result = await self.http.request("POST", AUTOSTOCKS_URL, "autostocks.upsert", json=data, headers=headers)
+            success = result.status in [200, 201]
+            if success:
+                if user_id not in user_autostocks_cache:
+                    user_autostocks_cache[user_id] = set()
+                user_autostocks_cache[user_id].add(item_name)
+                if log_sampler.should_log("autostock.add"):
+                    logger.info(f"✅ Добавлен: {user_id} -> {item_name}", extra={"user_id": user_id, "item": item_name})
+            return success
         except Exception as e:
             logger.error(f"❌ Сохранение: {e}")
             return False
     
     async def remove_user_autostock(self, user_id: int, item_name: str) -> bool:
         try:
-            session = await self.get_session()
             params = {"user_id": f"eq.{user_id}", "item_name": f"eq.{item_name}"}
-            async with session.delete(AUTOSTOCKS_URL, headers=self.headers, params=params, timeout=aiohttp.ClientTimeout(total=3)) as response:
-                success = response.status in [200, 204]
-                if success:
-                    if user_id in user_autostocks_cache:
-                        user_autostocks_cache[user_id].discard(item_name)
-                    logger.info(f"✅ Удален: {user_id} -> {item_name}")
-                return success
+            result = await self.http.request("DELETE", AUTOSTOCKS_URL, "autostocks.delete", headers=self.headers, params=params)
+            success = result.status in [200, 204]
+            if success:
+                if user_id in user_autostocks_cache:
+                    user_autostocks_cache[user_id].discard(item_name)
+                if log_sampler.should_log("autostock.remove"):
+                    logger.info(f"✅ Удален: {user_id} -> {item_name}", extra={"user_id": user_id, "item": item_name})
+            return success
         except Exception as e:
             logger.error(f"❌ Удаление: {e}")
             return False
     
-    async def get_users_tracking_item(self, item_name: str) -> List[int]:
+    async def iter_item_subscriptions(self, item_name: str, quantity: Optional[int] = None,
+                                      page_size: int = SUPABASE_PAGE_SIZE) -> AsyncIterator[List[Dict]]:
+        """Строки подписок с фильтрами; порог min_quantity проверяется на стороне PostgREST."""
+        params = {
+            "item_name": f"eq.{item_name}",
+            "select": ",".join(("user_id",) + FILTER_FIELDS),
+            "is_active": "not.is.false",
+        }
+        if quantity is not None:
+            params["or"] = f"(min_quantity.is.null,min_quantity.lte.{quantity})"
+        async for rows in self.iter_pages(AUTOSTOCKS_URL, "autostocks.by_item", params, "user_id", page_size):
+            yield rows
+    
+    async def get_autostock_filters(self, user_id: int, item_name: str) -> Optional[Dict]:
         try:
-            session = await self.get_session()
-            params = {"item_name": f"eq.{item_name}", "select": "user_id"}
-            async with session.get(AUTOSTOCKS_URL, headers=self.headers, params=params, timeout=aiohttp.ClientTimeout(total=3)) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    return [item['user_id'] for item in data]
-                return []
-        except:
-            return []
+            params = {"user_id": f"eq.{user_id}", "item_name": f"eq.{item_name}", "select": ",".join(FILTER_FIELDS)}
+            result = await self.http.request("GET", AUTOSTOCKS_URL, "autostocks.filters", headers=self.headers, params=params)
+            if result.status == 200 and result.data:
+                return result.data[0]
+            return None
+        except Exception as e:
+            logger.error(f"❌ Фильтры {user_id}: {e}")
+            return None
+    
+    async def update_autostock_filters(self, user_id: int, item_name: str, filters: Dict) -> bool:
+        try:
+            params = {"user_id": f"eq.{user_id}", "item_name": f"eq.{item_name}"}
+            result = await self.http.request("PATCH", AUTOSTOCKS_URL, "autostocks.set_filters", json=filters,
+                                             headers=self.headers, params=params)
+            return result.status in [200, 204]
+        except Exception as e:
+            logger.error(f"❌ Фильтры {user_id}: {e}")
+            return False
+
+# ========== ОЧЕРЕДЬ ОТПРАВКИ ==========
+class SendPipeline:
+    """Общий лимит отправки в Telegram: автостоки всегда идут раньше массовых рассылок."""
+    
+    def __init__(self, rate_per_second: float = SEND_RATE_PER_SECOND):
+        self.interval = 1 / rate_per_second
+        self.priority_jobs: deque = deque()
+        self.bulk_jobs: deque = deque()
+        self.bulk_slots = asyncio.Semaphore(BULK_QUEUE_LIMIT)
+        self.has_work = asyncio.Event()
+        self.next_send_at = 0.0
+        self.worker: Optional[asyncio.Task] = None
+    
+    def start(self):
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.create_task(self.run())
+    
+    def pause(self, seconds: float):
+        """Flood control от Telegram касается всего бота, поэтому тормозим всю очередь."""
+        self.next_send_at = max(self.next_send_at, time.monotonic() + seconds)
+    
+    async def enqueue(self, send, priority: bool = True) -> asyncio.Future:
+        """Ставит корутину-фабрику в очередь; для массовых задач ждет свободного места."""
+        future = asyncio.get_running_loop().create_future()
+        if priority:
+            self.priority_jobs.append((send, future))
+        else:
+            await self.bulk_slots.acquire()
+            self.bulk_jobs.append((send, future))
+        self.has_work.set()
+        return future
+    
+    async def submit(self, send, priority: bool = True):
+        return await (await self.enqueue(send, priority))
+    
+    async def run(self):
+        while True:
+            if self.priority_jobs:
+                send, future = self.priority_jobs.popleft()
+            elif self.bulk_jobs:
+                send, future = self.bulk_jobs.popleft()
+                self.bulk_slots.release()
+            else:
+                self.has_work.clear()
+                await self.has_work.wait()
+                continue
+            
+            if future.cancelled():
+                continue
+            
+            delay = self.next_send_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.next_send_at = max(self.next_send_at, time.monotonic()) + self.interval
+            asyncio.create_task(self.execute(send, future))
+    
+    async def execute(self, send, future: asyncio.Future):
+        try:
+            result = await send()
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(result)
+
+send_pipeline = SendPipeline()
+
+# ========== ФИЛЬТРЫ УВЕДОМЛЕНИЙ ==========
+class NotificationFilter:
+    """Правила подписок на один цикл: тихие часы считаются один раз на (пояс, окно)."""
+    
+    def __init__(self):
+        self.now_utc = datetime.now(pytz.UTC)
+        self.now = time.monotonic()
+        self.quiet_buckets: Dict[tuple, bool] = {}
+    
+    def is_quiet(self, tz_name: str, start: int, end: int) -> bool:
+        key = (tz_name, start, end)
+        quiet = self.quiet_buckets.get(key)
+        if quiet is None:
+            try:
+                tz = pytz.timezone(tz_name)
+            except pytz.UnknownTimeZoneError:
+                tz = pytz.timezone(DEFAULT_TIMEZONE)
+            hour = self.now_utc.astimezone(tz).hour
+            quiet = start <= hour < end if start < end else (hour >= start or hour < end)
+            self.quiet_buckets[key] = quiet
+        return quiet
+    
+    def allows(self, row: Dict, item_name: str, quantity: int) -> bool:
+        min_quantity = row.get("min_quantity")
+        if min_quantity and quantity < min_quantity:
+            return False
+        
+        start, end = row.get("quiet_start"), row.get("quiet_end")
+        if start is not None and end is not None and start != end:
+            if self.is_quiet(row.get("timezone") or DEFAULT_TIMEZONE, start, end):
+                return False
+        
+        cooldown = row.get("cooldown_minutes")
+        if cooldown:
+            last_sent = user_item_last_sent.get((row["user_id"], item_name))
+            if last_sent is not None and self.now - last_sent < cooldown * 60:
+                return False
+        return True
+    
+    def record_sent(self, row: Dict, item_name: str):
+        if row.get("cooldown_minutes"):
+            user_item_last_sent[(row["user_id"], item_name)] = self.now
+
+def prune_cooldowns():
+    cutoff = time.monotonic() - MAX_COOLDOWN_MINUTES * 60
+    for key in [key for key, sent_at in user_item_last_sent.items() if sent_at < cutoff]:
+        del user_item_last_sent[key]
+
+def parse_filter_args(args: List[str]) -> tuple:
+    """Разбирает `/filter <предмет> min=5 quiet=23-8 tz=Europe/Moscow cooldown=30`."""
+    name_parts = []
+    filters: Dict[str, Any] = {}
+    for arg in args:
+        if arg.lower() == "off":
+            filters.update({field: None for field in FILTER_FIELDS})
+            continue
+        if "=" not in arg:
+            name_parts.append(arg)
+            continue
+        key, value = arg.split("=", 1)
+        key = key.lower()
+        if key == "min":
+            filters["min_quantity"] = int(value) if value and int(value) > 1 else None
+        elif key == "quiet":
+            if value in ("", "off"):
+                filters["quiet_start"] = filters["quiet_end"] = None
+            else:
+                start, end = (int(hour) for hour in value.split("-", 1))
+                if not (0 <= start <= 23 and 0 <= end <= 23):
+                    raise ValueError(value)
+                filters["quiet_start"], filters["quiet_end"] = start, end
+        elif key == "tz":
+            pytz.timezone(value)
+            filters["timezone"] = value
+        elif key == "cooldown":
+            minutes = int(value) if value else 0
+            if not 0 <= minutes <= MAX_COOLDOWN_MINUTES:
+                raise ValueError(value)
+            filters["cooldown_minutes"] = minutes or None
+        else:
+            raise ValueError(key)
+    return " ".join(name_parts), filters
+
+def format_filters(filters: Dict) -> str:
+    lines = []
+    if filters.get("min_quantity"):
+        lines.append(f"📦 Минимум: x{filters['min_quantity']}")
+    if filters.get("quiet_start") is not None and filters.get("quiet_end") is not None:
+        lines.append(f"🌙 Тихие часы: {filters['quiet_start']:02d}:00-{filters['quiet_end']:02d}:00 ({filters.get('timezone') or DEFAULT_TIMEZONE})")
+    if filters.get("cooldown_minutes"):
+        lines.append(f"⏱ Не чаще раза в {filters['cooldown_minutes']} мин")
+    return "\n".join(lines) or "Без фильтров"
 
 # ========== DISCORD ПАРСЕР ==========
 class DiscordStockParser:
     def __init__(self):
         self.db = SupabaseDB()
         self.telegram_bot: Optional[Bot] = None
+        self.render_cache: Dict[str, tuple] = {}
+        self.fan_out_tasks: Set[asyncio.Task] = set()
+        # Ключи уведомлений, рассылка по которым еще идет в фоне
+        self.fan_out_keys: Set[str] = set()
     
     def parse_stock_message(self, content: str, channel_name: str) -> Dict:
         result = {"seeds": [], "gear": [], "eggs": [], "cosmetics": []}
@@ -344,72 +1057,159 @@ class DiscordStockParser:
                 clean_line = re.sub(r'[^\w\s\-]', '', line)
                 match = re.search(r'([A-Za-z\s\-]+)\s*x(\d+)', clean_line)
                 if match:
-                    item_name = match.group(1).strip()
+                    item_name = canonical_item_name(match.group(1).strip())
                     quantity = int(match.group(2))
                     if quantity > 0:
                         result[current_section].append((item_name, quantity))
         
         return result
     
-    def format_stock_message(self, stock_data: Dict) -> str:
+    def render_cached(self, key: str, version: int, builder) -> str:
+        cached = self.render_cache.get(key)
+        if cached and cached[0] == version:
+            return cached[1]
+        text = builder()
+        self.render_cache[key] = (version, text)
+        return text
+    
+    def render_stock_message(self, stock_data: Dict) -> str:
+        if stock_data is not cached_stock_data:
+            return self.format_stock_message(stock_data)
+        return self.render_cached("stock", stock_snapshot_version,
+                                  lambda: self.format_stock_message(stock_data, stock_snapshot_time))
+    
+    def render_cosmetics_message(self, cosmetics_data: Dict) -> str:
+        if cosmetics_data is not cached_cosmetics_data:
+            return self.format_cosmetics_message(cosmetics_data)
+        return self.render_cached("cosmetics", cosmetics_snapshot_version,
+                                  lambda: self.format_cosmetics_message(cosmetics_data, cosmetics_snapshot_time))
+    
+    def format_stock_message(self, stock_data: Dict, timestamp: Optional[str] = None) -> str:
         if not stock_data:
             return "❌ *Не удалось получить данные*"
         
-        message = "📊 *ТЕКУЩИЙ СТОК*\n\n"
+        parts = ["📊 *ТЕКУЩИЙ СТОК*\n\n"]
         
         for category, emoji, title in [('seeds', '🌱', 'СЕМЕНА'), ('gear', '⚔️', 'ГИРЫ'), ('eggs', '🥚', 'ЯЙЦА')]:
             items = stock_data.get(category, [])
             if items:
-                message += f"{emoji} *{title}:*\n"
+                parts.append(f"{emoji} *{title}:*\n")
                 for item_name, quantity in items:
-                    if category == 'seeds':
-                        item_info = SEEDS_DATA.get(item_name, {"emoji": emoji, "price": "?"})
-                    elif category == 'gear':
-                        item_info = GEAR_DATA.get(item_name, {"emoji": "⚔️", "price": "?"})
-                    else:
-                        item_info = EGGS_DATA.get(item_name, {"emoji": "🥚", "price": "?"})
-                    message += f"{item_info['emoji']} {item_name} x{quantity}\n"
-                message += "\n"
+                    label = ITEM_LABELS.get(item_name) or f"{emoji} {item_name}"
+                    parts.append(f"{label} x{quantity}\n")
+                parts.append("\n")
             else:
-                message += f"{emoji} *{title}:* _Пусто_\n\n"
+                parts.append(f"{emoji} *{title}:* _Пусто_\n\n")
         
-        message += f"🕒 {format_moscow_time()}"
-        return message
+        parts.append(f"🕒 {timestamp or format_moscow_time()}")
+        return "".join(parts)
     
-    def format_cosmetics_message(self, cosmetics_data: Dict) -> str:
+    def format_cosmetics_message(self, cosmetics_data: Dict, timestamp: Optional[str] = None) -> str:
         if not cosmetics_data:
             return "❌ *Не удалось получить данные*"
         
-        message = "👗 *COSMETICS SHOP*\n\n"
+        parts = ["👗 *COSMETICS SHOP*\n\n"]
         items = cosmetics_data.get('cosmetics', [])
         
         if items:
             for item_name, quantity in items:
-                item_info = COSMETICS_DATA.get(item_name, {"emoji": "📦", "price": "?"})
-                message += f"{item_info['emoji']} {item_name} x{quantity}\n"
+                label = ITEM_LABELS.get(item_name) or f"📦 {item_name}"
+                parts.append(f"{label} x{quantity}\n")
         else:
-            message += "_Пусто_"
+            parts.append("_Пусто_")
         
-        message += f"\n\n🕒 {format_moscow_time()}"
-        return message
+        parts.append(f"\n\n🕒 {timestamp or format_moscow_time()}")
+        return "".join(parts)
     
-    async def send_autostock_notification(self, bot: Bot, user_id: int, item_name: str, count: int):
+    async def deliver_message(self, bot: Bot, chat_id: int, text: str, parse_mode: Optional[str] = ParseMode.MARKDOWN,
+                              priority: bool = True, retry: bool = True) -> str:
         try:
-            item_info = ITEMS_DATA.get(item_name, {"emoji": "📦", "price": "?"})
-            message = (
-                f"🔔 *АВТОСТОК*\n\n"
-                f"{item_info['emoji']} *{item_name}*\n"
-                f"📦 x{count}\n"
-                f"💰 {item_info['price']} ¢\n\n"
-                f"🕒 {format_moscow_time()}"
-            )
-            await bot.send_message(chat_id=user_id, text=message, parse_mode=ParseMode.MARKDOWN)
-            logger.info(f"📤 {user_id} -> {item_name}")
+            await bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode)
+            return DELIVERY_SENT
+        except RetryAfter as e:
+            send_pipeline.pause(e.retry_after)
+            if not retry:
+                logger.error(f"❌ {chat_id}: {e}")
+                return DELIVERY_TRANSIENT
+            # Повтор идет через очередь: пауза и общий темп pipeline действуют и на него
+            resend = functools.partial(self.deliver_message, bot, chat_id, text, parse_mode, priority, False)
+            return await send_pipeline.submit(resend, priority)
         except Exception as e:
-            logger.error(f"❌ {user_id}: {e}")
+            outcome = classify_send_error(e)
+            if outcome == DELIVERY_PERMANENT:
+                self.mark_unreachable(chat_id, e)
+            else:
+                logger.error(f"❌ {chat_id}: {e}")
+            return outcome
+    
+    async def send_autostock_notification(self, bot: Bot, user_id: int, item_name: str, message: str,
+                                          latencies: Optional[List[float]] = None) -> str:
+        started = time.monotonic()
+        outcome = await self.deliver_message(bot, user_id, message)
+        latency_ms = (time.monotonic() - started) * 1000
+        if latencies is not None:
+            latencies.append(latency_ms)
+        # Каждая отправка попадает в сводку цикла; в лог - только выборка
+        if outcome == DELIVERY_SENT and log_sampler.should_log("autostock.send"):
+            logger.info(f"📤 {user_id} -> {item_name}",
+                        extra={"user_id": user_id, "item": item_name, "latency_ms": round(latency_ms, 1)})
+        return outcome
+    
+    def mark_unreachable(self, user_id: int, error: Exception):
+        if user_id in inactive_users:
+            return
+        inactive_users.add(user_id)
+        user_autostocks_cache.pop(user_id, None)
+        logger.warning(f"🚫 {user_id} недоступен ({error}), отключен от рассылки")
+        asyncio.create_task(self.db.set_user_active(user_id, False))
+    
+    async def reactivate_user(self, user_id: int):
+        inactive_users.discard(user_id)
+        # Строку users уже поднимает save_user (upsert с is_active: True) - здесь только автостоки
+        await self.db.set_autostocks_active(user_id, True)
+    
+    async def fan_out_item(self, bot: Bot, item_name: str, count: int, rules: NotificationFilter,
+                           notify_key: str) -> Dict[str, int]:
+        """Запускает отправку по каждой странице подписчиков, не дожидаясь остальных страниц."""
+        # Текст собирается один раз на предмет за цикл и разделяется всеми получателями
+        message = build_autostock_message(item_name, count, format_moscow_time())
+        latencies: List[float] = []
+        tasks = []
+        sent_rows = []
+        skipped = 0
+        filtered = 0
+        try:
+            async for rows in self.db.iter_item_subscriptions(item_name, count):
+                for row in rows:
+                    if row["user_id"] in inactive_users:
+                        skipped += 1
+                        continue
+                    if not rules.allows(row, item_name, count):
+                        filtered += 1
+                        continue
+                    send = functools.partial(self.send_autostock_notification, bot, row["user_id"], item_name, message, latencies)
+                    tasks.append(asyncio.create_task(send_pipeline.submit(send)))
+                    sent_rows.append(row)
+                if tasks:
+                    # Ключ пишется до отправки: рестарт посреди рассылки не повторит ее уже получившим
+                    mark_notified_now(notify_key)
+            mark_notified_now(notify_key)
+        except Exception as e:
+            # Уже запущенные отправки не отменяем: иначе следующий цикл продублирует их
+            logger.error(f"❌ Подписчики {item_name} после {len(tasks)}: {e}")
+        
+        outcomes = {DELIVERY_SENT: 0, DELIVERY_PERMANENT: 0, DELIVERY_TRANSIENT: 0,
+                    DELIVERY_SKIPPED: skipped, DELIVERY_FILTERED: filtered}
+        for row, outcome in zip(sent_rows, await asyncio.gather(*tasks, return_exceptions=True)):
+            if isinstance(outcome, Exception):
+                outcome = DELIVERY_TRANSIENT
+            if outcome == DELIVERY_SENT:
+                rules.record_sent(row, item_name)
+            outcomes[outcome] += 1
+        outcomes["latency_ms"] = round(sum(latencies) / len(latencies), 1) if latencies else 0
+        return outcomes
     
     async def check_user_autostocks(self, stock_data: Dict, bot: Bot):
-        global last_autostock_notification
         if not stock_data:
             return
 
@@ -419,38 +1219,427 @@ class DiscordStockParser:
                 if quantity > 0:
                     current_stock[item_name] = quantity
 
-        items_to_check = []
-        now = get_moscow_time()
-        for item_name in current_stock.keys():
-            if item_name not in last_autostock_notification:
-                items_to_check.append(item_name)
-            else:
-                if (now - last_autostock_notification[item_name]).total_seconds() >= 300:
-                    items_to_check.append(item_name)
+        # Ключ уведомления - хэш исходных сообщений и разобранного снапшота, а не время
+        snapshot_key = stock_snapshot_key if stock_data is cached_stock_data else None
+        snapshot_key = snapshot_key or snapshot_content_key([], stock_data)
+        item_keys = {item_name: f"{snapshot_key}:{item_name}" for item_name in current_stock}
+        items_to_check = [item_name for item_name, key in item_keys.items()
+                          if not dedup_ledger.was_notified(key) and key not in self.fan_out_keys]
         
         if not items_to_check:
             return
         
         logger.info(f"🔍 Проверка: {len(items_to_check)} предметов")
         
-        tasks = [self.db.get_users_tracking_item(item_name) for item_name in items_to_check]
+        prune_cooldowns()
+        rules = NotificationFilter()
+        # Отправки идут в темпе очереди; проверка стока не ждет их итогов, как и до очереди
+        keys = {item_keys[item_name] for item_name in items_to_check}
+        self.fan_out_keys.update(keys)
+        task = asyncio.create_task(self.run_fan_out(bot, items_to_check, current_stock, item_keys, rules))
+        self.fan_out_tasks.add(task)
+        
+        def finished(done: asyncio.Task):
+            self.fan_out_tasks.discard(done)
+            self.fan_out_keys.difference_update(keys)
+        
+        task.add_done_callback(finished)
+    
+    async def run_fan_out(self, bot: Bot, items_to_check: List[str], current_stock: Dict[str, int],
+                          item_keys: Dict[str, str], rules: NotificationFilter):
+        tasks = [self.fan_out_item(bot, item_name, current_stock[item_name], rules, item_keys[item_name])
+                 for item_name in items_to_check]
         results = await asyncio.gather(*tasks, return_exceptions=True)
         
-        send_count = 0
+        totals = {DELIVERY_SENT: 0, DELIVERY_PERMANENT: 0, DELIVERY_TRANSIENT: 0, DELIVERY_SKIPPED: 0, DELIVERY_FILTERED: 0}
         for item_name, result in zip(items_to_check, results):
-            if not isinstance(result, Exception) and result:
-                count = current_stock[item_name]
-                logger.info(f"📨 {item_name}: {len(result)} пользователей")
-                for user_id in result:
-                    asyncio.create_task(self.send_autostock_notification(bot, user_id, item_name, count))
-                    send_count += 1
-                last_autostock_notification[item_name] = now
+            if isinstance(result, Exception):
+                logger.error(f"❌ Рассылка {item_name}: {result}")
+                continue
+            latency_ms = result.pop("latency_ms")
+            attempted = result[DELIVERY_SENT] + result[DELIVERY_PERMANENT] + result[DELIVERY_TRANSIENT]
+            if attempted:
+                logger.info(f"📨 {item_name}: {attempted} пользователей, {result[DELIVERY_SENT]} доставлено",
+                            extra={"item": item_name, "count": attempted, "latency_ms": latency_ms})
+            for outcome, value in result.items():
+                totals[outcome] += value
         
-        if send_count > 0:
-            logger.info(f"✅ Отправлено {send_count} уведомлений")
+        if totals[DELIVERY_SENT] > 0:
+            logger.info(f"✅ Отправлено {totals[DELIVERY_SENT]} уведомлений")
+        if totals[DELIVERY_FILTERED]:
+            logger.info(f"🔕 Отфильтровано: {totals[DELIVERY_FILTERED]}")
+        if totals[DELIVERY_PERMANENT] or totals[DELIVERY_SKIPPED] or totals[DELIVERY_TRANSIENT]:
+            logger.info(
+                f"🚫 Недоставлено: отключено {totals[DELIVERY_PERMANENT]}, "
+                f"пропущено неактивных {totals[DELIVERY_SKIPPED]}, временных ошибок {totals[DELIVERY_TRANSIENT]}"
+            )
 
 parser = DiscordStockParser()
 
+# ========== РАССЫЛКА ==========
+class BroadcastManager:
+    """Массовая рассылка по таблице users с чекпоинтом в файле для продолжения после рестарта."""
+    
+    def __init__(self, state_file: str = BROADCAST_STATE_FILE):
+        self.state_file = state_file
+        self.state: Optional[Dict] = None
+        self.task: Optional[asyncio.Task] = None
+        self.run_started_at = 0.0
+        self.run_started_sent = 0
+        # Отличает /broadcast stop от отмены задачи при остановке бота
+        self.stopping = False
+    
+    @property
+    def active(self) -> bool:
+        return self.task is not None and not self.task.done()
+    
+    @property
+    def interrupted(self) -> bool:
+        """Есть чекпоинт незавершенной рассылки, но она сейчас не идет."""
+        return not self.active and os.path.exists(self.state_file)
+    
+    async def start(self, bot: Bot, admin_chat_id: int, text: str):
+        total = None
+        try:
+            total = await parser.db.count_rows(USERS_URL, "users.count", {"is_active": "not.is.false"})
+        except Exception as e:
+            logger.error(f"❌ Подсчет пользователей: {e}")
+        
+        status = await bot.send_message(chat_id=admin_chat_id, text="📣 Рассылка запускается...")
+        self.state = {
+            "text": text,
+            "admin_chat_id": admin_chat_id,
+            "status_message_id": status.message_id,
+            "last_user_id": None,
+            "sent": 0,
+            "failed": 0,
+            "total": total,
+        }
+        save_json_state(self.state_file, self.state)
+        self.launch(bot)
+    
+    def resume(self, bot: Bot) -> bool:
+        state = load_json_state(self.state_file, None)
+        if not state or self.active:
+            return False
+        self.state = state
+        logger.info(f"📣 Продолжение рассылки после {state['last_user_id']}")
+        self.launch(bot)
+        return True
+    
+    def launch(self, bot: Bot):
+        self.run_started_at = time.monotonic()
+        self.run_started_sent = self.state["sent"] + self.state["failed"]
+        self.stopping = False
+        self.task = asyncio.create_task(self.run(bot))
+    
+    def stop(self) -> bool:
+        if not self.active:
+            return False
+        self.stopping = True
+        self.task.cancel()
+        return True
+    
+    def discard(self) -> bool:
+        if not self.interrupted:
+            return False
+        self.clear()
+        return True
+    
+    def format_progress(self, finished: bool = False, stopped: bool = False) -> str:
+        state = self.state
+        processed = state["sent"] + state["failed"]
+        total = state["total"]
+        if stopped:
+            title = "🛑 *Рассылка остановлена*"
+        elif finished:
+            title = "✅ *Рассылка завершена*"
+        else:
+            title = "📣 *Рассылка*"
+        lines = [title, "", f"📤 Отправлено: {state['sent']}", f"🚫 Ошибок: {state['failed']}"]
+        if total:
+            lines.append(f"📊 {processed}/{total} ({processed * 100 // max(total, 1)}%)")
+        elapsed = time.monotonic() - self.run_started_at
+        done_this_run = processed - self.run_started_sent
+        if not finished and not stopped and total and done_this_run > 0 and elapsed > 0:
+            eta = int(max(total - processed, 0) / (done_this_run / elapsed))
+            lines.append(f"⏳ Осталось: ~{eta // 60}м {eta % 60}с")
+        return "\n".join(lines)
+    
+    async def report(self, bot: Bot, finished: bool = False, stopped: bool = False):
+        try:
+            await bot.edit_message_text(
+                chat_id=self.state["admin_chat_id"],
+                message_id=self.state["status_message_id"],
+                text=self.format_progress(finished, stopped),
+                parse_mode=ParseMode.MARKDOWN
+            )
+        except Exception as e:
+            logger.warning(f"⚠️ Прогресс рассылки: {e}")
+    
+    async def run(self, bot: Bot):
+        state = self.state
+        last_report = time.monotonic()
+        params = {"select": "user_id", "is_active": "not.is.false"}
+        try:
+            async for rows in parser.db.iter_pages(USERS_URL, "users.page", params, "user_id", after=state["last_user_id"]):
+                futures = []
+                for row in rows:
+                    user_id = row["user_id"]
+                    if user_id in inactive_users:
+                        continue
+                    send = functools.partial(parser.deliver_message, bot, user_id, state["text"], None, False)
+                    futures.append(await send_pipeline.enqueue(send, priority=False))
+                
+                for outcome in await asyncio.gather(*futures, return_exceptions=True):
+                    if outcome == DELIVERY_SENT:
+                        state["sent"] += 1
+                    else:
+                        state["failed"] += 1
+                
+                # Чекпоинт только после завершения страницы, чтобы не пропустить неотправленных
+                state["last_user_id"] = rows[-1]["user_id"]
+                save_json_state(self.state_file, state)
+                
+                if time.monotonic() - last_report >= BROADCAST_PROGRESS_SECONDS:
+                    last_report = time.monotonic()
+                    await self.report(bot)
+        except asyncio.CancelledError:
+            if not self.stopping:
+                # Остановка бота: чекпоинт остается, рассылка продолжится после рестарта
+                logger.info(f"⏸ Рассылка прервана после {state['last_user_id']}")
+                raise
+            logger.info("🛑 Рассылка остановлена")
+            await self.report(bot, stopped=True)
+            self.clear()
+            raise
+        except Exception as e:
+            # Состояние остается в файле: рассылку можно продолжить командой или после рестарта
+            logger.error(f"❌ Рассылка: {e}")
+            await self.report(bot)
+            try:
+                await bot.send_message(
+                    chat_id=state["admin_chat_id"],
+                    text=f"❌ Рассылка прервана: {e}\n\n/broadcast resume - продолжить\n/broadcast stop - отменить"
+                )
+            except Exception as notify_error:
+                logger.warning(f"⚠️ Уведомление о рассылке: {notify_error}")
+            return
+        
+        logger.info(f"✅ Рассылка завершена: {state['sent']} отправлено, {state['failed']} ошибок")
+        await self.report(bot, finished=True)
+        self.clear()
+    
+    def clear(self):
+        self.state = None
+        try:
+            os.remove(self.state_file)
+        except FileNotFoundError:
+            pass
+
+broadcast_manager = BroadcastManager()
+
+# ========== ЖИВОЕ ТАБЛО ==========
+class LiveBoard:
+    """Одно закрепленное сообщение на чат, обновляемое через edit_message_text."""
+    
+    def __init__(self, chats: List[str], state_file: str = LIVE_BOARD_STATE_FILE):
+        self.chats = chats
+        self.state_file = state_file
+        self.boards: Dict[str, Dict] = load_json_state(state_file, {})
+    
+    async def update(self, bot: Bot, text: str):
+        if not self.chats:
+            return
+        
+        text_hash = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        # Все чаты встают в очередь сразу, а не по одному после каждой отправки
+        changed = await asyncio.gather(*(self.update_chat(bot, chat_id, text, text_hash) for chat_id in self.chats))
+        if any(changed):
+            save_json_state(self.state_file, self.boards)
+    
+    async def update_chat(self, bot: Bot, chat_id: str, text: str, text_hash: str) -> bool:
+        board = self.boards.get(chat_id)
+        if board and board.get("hash") == text_hash:
+            return False
+        publish = functools.partial(self.publish, bot, chat_id, board, text)
+        try:
+            try:
+                message_id = await send_pipeline.submit(publish)
+            except RetryAfter as e:
+                # Flood control касается всего бота: тормозим общую очередь и повторяем через нее, как deliver_message
+                send_pipeline.pause(e.retry_after)
+                message_id = await send_pipeline.submit(publish)
+        except Exception as e:
+            if isinstance(e, RetryAfter):
+                send_pipeline.pause(e.retry_after)
+            logger.error(f"❌ Табло {chat_id}: {e}")
+            return False
+        self.boards[chat_id] = {"message_id": message_id, "hash": text_hash}
+        return True
+    
+    async def publish(self, bot: Bot, chat_id: str, board: Optional[Dict], text: str) -> int:
+        if board:
+            try:
+                await bot.edit_message_text(chat_id=chat_id, message_id=board["message_id"], text=text, parse_mode=ParseMode.MARKDOWN)
+                return board["message_id"]
+            except BadRequest as e:
+                if "not modified" in str(e).lower():
+                    return board["message_id"]
+                # Сообщение удалено или слишком старое для редактирования: публикуем заново
+                logger.warning(f"⚠️ Табло {chat_id}: {e}")
+        
+        message = await bot.send_message(chat_id=chat_id, text=text, parse_mode=ParseMode.MARKDOWN, disable_notification=True)
+        try:
+            await bot.pin_chat_message(chat_id=chat_id, message_id=message.message_id, disable_notification=True)
+        except RetryAfter as e:
+            send_pipeline.pause(e.retry_after)
+            logger.warning(f"⚠️ Табло {chat_id}: не удалось закрепить ({e})")
+        except TelegramError as e:
+            logger.warning(f"⚠️ Табло {chat_id}: не удалось закрепить ({e})")
+        logger.info(f"📌 Табло {chat_id}: новое сообщение {message.message_id}")
+        return message.message_id
+
+live_board = LiveBoard(LIVE_BOARD_CHATS)
+
+# ========== STOCK API ==========
+def items_payload(items: List[tuple]) -> List[Dict]:
+    return [
+        {"name": item_name, "quantity": quantity,
+         "emoji": ITEMS_DATA.get(item_name, {}).get("emoji"), "price": ITEMS_DATA.get(item_name, {}).get("price")}
+        for item_name, quantity in items
+    ]
+
+def snapshot_diff(old: Optional[Dict], new: Dict) -> Dict:
+    """Разница двух снапшотов по категориям: появившиеся/изменившиеся количества и исчезнувшие предметы."""
+    diff = {}
+    for category, items in new.items():
+        if not isinstance(items, list):
+            continue
+        before = {item["name"]: item["quantity"] for item in (old or {}).get(category, [])}
+        after = {item["name"]: item["quantity"] for item in items}
+        changed = {name: quantity for name, quantity in after.items() if before.get(name) != quantity}
+        removed = [name for name in before if name not in after]
+        if changed or removed:
+            diff[category] = {"changed": changed, "removed": removed}
+    return diff
+
+class StockAPI:
+    """JSON-снапшоты с ETag и SSE-поток изменений; все клиенты читают один разобранный снапшот."""
+    
+    def __init__(self, host: str = STOCK_API_HOST, port: int = STOCK_API_PORT):
+        self.host = host
+        self.port = port
+        self.snapshots: Dict[str, tuple] = {}
+        self.subscribers: Set[asyncio.Queue] = set()
+        self.runner: Optional[web.AppRunner] = None
+    
+    @property
+    def enabled(self) -> bool:
+        return self.port > 0
+    
+    def publish(self, kind: str, payload: Dict):
+        body = json.dumps(payload, ensure_ascii=False, sort_keys=True).encode('utf-8')
+        etag = f'"{hashlib.sha1(body).hexdigest()[:16]}"'
+        previous = self.snapshots.get(kind)
+        if previous and previous[0] == etag:
+            return
+        self.snapshots[kind] = (etag, body, payload)
+        
+        if kind == "weather":
+            event = {"kind": kind, "snapshot": payload}
+        else:
+            event = {"kind": kind, "version": payload.get("version"),
+                     "diff": snapshot_diff(previous[2] if previous else None, payload)}
+        message = f"event: {kind}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n".encode('utf-8')
+        for subscriber in list(self.subscribers):
+            try:
+                subscriber.put_nowait(message)
+            except asyncio.QueueFull:
+                # Медленный клиент не должен тормозить остальных: отключаем его
+                self.subscribers.discard(subscriber)
+                while not subscriber.empty():
+                    subscriber.get_nowait()
+                subscriber.put_nowait(None)
+    
+    def publish_stock(self):
+        if not self.enabled or cached_stock_data is None:
+            return
+        payload = {"version": stock_snapshot_version, "time": stock_snapshot_time}
+        for category in ['seeds', 'gear', 'eggs']:
+            payload[category] = items_payload(cached_stock_data.get(category, []))
+        self.publish("stock", payload)
+    
+    def publish_cosmetics(self):
+        if not self.enabled or cached_cosmetics_data is None:
+            return
+        self.publish("cosmetics", {
+            "version": cosmetics_snapshot_version,
+            "time": cosmetics_snapshot_time,
+            "cosmetics": items_payload(cached_cosmetics_data.get("cosmetics", [])),
+        })
+    
+    def publish_weather(self, text: str):
+        if self.enabled:
+            self.publish("weather", {"text": text})
+    
+    async def handle_snapshot(self, request: web.Request) -> web.StreamResponse:
+        snapshot = self.snapshots.get(request.match_info["kind"])
+        if snapshot is None:
+            return web.json_response({"error": "no data yet"}, status=503)
+        
+        etag, body, _ = snapshot
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if etag in request.headers.get("If-None-Match", ""):
+            return web.Response(status=304, headers=headers)
+        return web.Response(body=body, content_type="application/json", charset="utf-8", headers=headers)
+    
+    async def handle_events(self, request: web.Request) -> web.StreamResponse:
+        response = web.StreamResponse(headers={
+            "Content-Type": "text/event-stream",
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+        })
+        await response.prepare(request)
+        
+        subscriber: asyncio.Queue = asyncio.Queue(maxsize=STOCK_API_SUBSCRIBER_QUEUE)
+        self.subscribers.add(subscriber)
+        try:
+            # Начальное состояние - отдельным событием, чтобы клиент не принял его за diff
+            for kind, (_, _, payload) in list(self.snapshots.items()):
+                event = {"kind": kind, "snapshot": payload}
+                await response.write(f"event: snapshot\ndata: {json.dumps(event, ensure_ascii=False)}\n\n".encode('utf-8'))
+            while True:
+                try:
+                    message = await asyncio.wait_for(subscriber.get(), timeout=STOCK_API_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    message = b": keep-alive\n\n"
+                if message is None:
+                    break
+                await response.write(message)
+        except ConnectionResetError:
+            pass
+        finally:
+            self.subscribers.discard(subscriber)
+        return response
+    
+    async def start(self):
+        if not self.enabled:
+            return
+        app = web.Application()
+        app.router.add_get("/events", self.handle_events)
+        app.router.add_get("/{kind:stock|cosmetics|weather}", self.handle_snapshot)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        logger.info(f"🌐 Stock API: http://{self.host}:{self.port}")
+    
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+
+stock_api = StockAPI()
+
 # ========== DISCORD CLIENT ==========
 class StockDiscordClient(discord.Client):
     def __init__(self):
@@ -464,8 +1653,48 @@ class StockDiscordClient(discord.Client):
             if channel:
                 logger.info(f"✅ {channel_name}: {channel.name}")
     
+    async def on_message(self, message: discord.Message):
+        # Для API обновляем снапшот сразу по приходу нового сообщения, не дожидаясь опроса
+        if not stock_api.enabled or not message.author.bot:
+            return
+        global cached_stock_time, cached_cosmetics_time, cached_weather_time
+        channel_id = message.channel.id
+        try:
+            if channel_id in (DISCORD_CHANNELS["stock"], DISCORD_CHANNELS["egg_stock"]):
+                cached_stock_time = None
+                await self.fetch_stock_data()
+            elif channel_id == DISCORD_CHANNELS["cosmetics"]:
+                cached_cosmetics_time = None
+                await self.fetch_cosmetics_data()
+            elif channel_id == DISCORD_CHANNELS["weather"]:
+                cached_weather_time = None
+                await self.fetch_weather_data()
+        except Exception as e:
+            logger.error(f"❌ on_message {channel_id}: {e}")
+    
+    def parse_stock_discord_message(self, msg, channel_name: str) -> Dict:
+        """Собирает текст из embeds/сообщения и разбирает сток; {} если это не сообщение о стоке."""
+        content = ""
+        
+        # Проверяем embeds
+        if msg.embeds:
+            for embed in msg.embeds:
+                if embed.title and ('Stock' in embed.title or 'Shop' in embed.title):
+                    if embed.description:
+                        content += embed.description + "\n"
+                    for field in embed.fields:
+                        content += f"{field.name}\n{field.value}\n"
+        
+        # Проверяем обычное сообщение
+        if msg.content and ('Stock' in msg.content or 'Grow a Garden' in msg.content):
+            content += msg.content
+        
+        if content and ('x' in content or 'Seeds' in content or 'Gear' in content or 'Egg' in content):
+            return parser.parse_stock_message(content, channel_name)
+        return {}
+    
     async def fetch_stock_data(self) -> Dict:
-        global cached_stock_data, cached_stock_time
+        global cached_stock_data, cached_stock_time, stock_snapshot_version, stock_snapshot_time, stock_snapshot_key
         
         now = get_moscow_time()
         if cached_stock_data and cached_stock_time:
@@ -474,6 +1703,7 @@ class StockDiscordClient(discord.Client):
         
         async with self.stock_lock:
             stock_data = {"seeds": [], "gear": [], "eggs": []}
+            sources: List[str] = []
             
             for channel_name in ["stock", "egg_stock"]:
                 if channel_name not in DISCORD_CHANNELS:
@@ -494,25 +1724,17 @@ class StockDiscordClient(discord.Client):
                     async for msg in channel.history(limit=5):
                         # Ищем сообщения от ботов с информацией о стоке
                         if msg.author.bot:
-                            content = ""
-                            
-                            # Проверяем embeds
-                            if msg.embeds:
-                                for embed in msg.embeds:
-                                    if embed.title and ('Stock' in embed.title or 'Shop' in embed.title):
-                                        if embed.description:
-                                            content += embed.description + "\n"
-                                        for field in embed.fields:
-                                            content += f"{field.name}\n{field.value}\n"
-                            
-                            # Проверяем обычное сообщение
-                            if msg.content and ('Stock' in msg.content or 'Grow a Garden' in msg.content):
-                                content += msg.content
+                            message_key = f"{channel_name}:{discord_message_key(msg)}"
+                            parsed = dedup_ledger.get_parsed(message_key)
+                            if parsed is None:
+                                parsed = self.parse_stock_discord_message(msg, channel_name)
+                                dedup_ledger.put_parsed(message_key, parsed)
                             
-                            if content and ('x' in content or 'Seeds' in content or 'Gear' in content or 'Egg' in content):
-                                parsed = parser.parse_stock_message(content, channel_name)
+                            if parsed:
+                                # Для уведомлений - id без времени правки: правка без изменений не повторяет рассылку
+                                sources.append(f"{channel_name}:{msg.id}")
                                 for category in ['seeds', 'gear', 'eggs']:
-                                    if parsed[category]:
+                                    if parsed.get(category):
                                         stock_data[category].extend(parsed[category])
                                 
                                 if stock_data['seeds'] or stock_data['gear'] or stock_data['eggs']:
@@ -524,8 +1746,16 @@ class StockDiscordClient(discord.Client):
                 except Exception as e:
                     logger.error(f"❌ {channel_name}: {e}")
             
+            changed = stock_data != cached_stock_data
+            if changed:
+                stock_snapshot_version += 1
+                stock_snapshot_time = now.strftime('%H:%M:%S')
+            stock_snapshot_key = snapshot_content_key(sources, stock_data)
+            dedup_ledger.flush()
             cached_stock_data = stock_data
             cached_stock_time = now
+            if changed:
+                stock_api.publish_stock()
             
             if not stock_data['seeds'] and not stock_data['gear'] and not stock_data['eggs']:
                 logger.warning("⚠️ Не удалось получить данные ни из одного канала")
@@ -533,7 +1763,7 @@ class StockDiscordClient(discord.Client):
             return stock_data
     
     async def fetch_cosmetics_data(self) -> Dict:
-        global cached_cosmetics_data, cached_cosmetics_time
+        global cached_cosmetics_data, cached_cosmetics_time, cosmetics_snapshot_version, cosmetics_snapshot_time
         
         now = get_moscow_time()
         if cached_cosmetics_data and cached_cosmetics_time:
@@ -558,8 +1788,12 @@ class StockDiscordClient(discord.Client):
                         content += "\n" + msg.embeds[0].description
                     
                     parsed = parser.parse_stock_message(content, "cosmetics")
+                    if parsed != cached_cosmetics_data:
+                        cosmetics_snapshot_version += 1
+                        cosmetics_snapshot_time = now.strftime('%H:%M:%S')
                     cached_cosmetics_data = parsed
                     cached_cosmetics_time = now
+                    stock_api.publish_cosmetics()
                     return parsed
             
             return {"cosmetics": []}
@@ -618,6 +1852,7 @@ class StockDiscordClient(discord.Client):
             if not found:
                 message_text += "_Нет активной погоды_\n"
             
+            stock_api.publish_weather(message_text)
             message_text += f"\n🕒 {format_moscow_time()}"
             cached_weather_data = message_text
             cached_weather_time = now
@@ -629,6 +1864,176 @@ class StockDiscordClient(discord.Client):
             logger.error(f"❌ weather: {e}")
             return f"❌ *Ошибка получения погоды*"
 
+# ========== ЗАЩИТА ОТ ФЛУДА ==========
+class UserRateLimiter:
+    """Token bucket на пользователя; таблица ограничена по размеру и вытесняет давно неактивных."""
+    
+    def __init__(self, rate: float = THROTTLE_RATE_PER_SECOND, burst: int = THROTTLE_BURST, max_users: int = THROTTLE_MAX_USERS):
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        self.buckets: OrderedDict = OrderedDict()
+    
+    def allow(self, user_id: int) -> bool:
+        now = time.monotonic()
+        bucket = self.buckets.get(user_id)
+        if bucket is None:
+            tokens = self.burst
+            if len(self.buckets) >= self.max_users:
+                self.buckets.popitem(last=False)
+        else:
+            tokens, updated = bucket
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            self.buckets.move_to_end(user_id)
+        
+        if tokens < 1:
+            self.buckets[user_id] = (tokens, now)
+            return False
+        self.buckets[user_id] = (tokens - 1, now)
+        return True
+
+class ToggleCoalescer:
+    """Склеивает быстрые нажатия на предметы: в базу пишется только итоговое состояние."""
+    
+    def __init__(self, delay: float = TOGGLE_DEBOUNCE_SECONDS):
+        self.delay = delay
+        self.pending: Dict[int, Dict[str, bool]] = {}
+        self.inflight: Dict[int, Dict[str, bool]] = {}
+        self.refreshers: Dict[int, Any] = {}
+        self.timers: Dict[int, asyncio.TimerHandle] = {}
+        self.locks: Dict[int, asyncio.Lock] = {}
+    
+    def desired_state(self, user_id: int, item_name: str) -> Optional[bool]:
+        """Последнее нажатие, ещё не подтверждённое базой: ожидающее или записываемое сейчас."""
+        for states in (self.pending.get(user_id), self.inflight.get(user_id)):
+            if states and item_name in states:
+                return states[item_name]
+        return None
+    
+    async def toggle(self, user_id: int, item_name: str, refresh) -> bool:
+        """Переключает желаемое состояние и откладывает запись; возвращает новое состояние."""
+        current = self.desired_state(user_id, item_name)
+        if current is None:
+            current = item_name in await parser.db.load_user_autostocks(user_id)
+            # Пока шла загрузка, могло прийти ещё одно нажатие
+            known = self.desired_state(user_id, item_name)
+            if known is not None:
+                current = known
+        self.pending.setdefault(user_id, {})[item_name] = not current
+        self.refreshers[user_id] = refresh
+        
+        timer = self.timers.pop(user_id, None)
+        if timer:
+            timer.cancel()
+        self.timers[user_id] = asyncio.get_running_loop().call_later(
+            self.delay, lambda: asyncio.create_task(self.flush(user_id))
+        )
+        return not current
+    
+    async def flush(self, user_id: int):
+        # Сработавший таймер убираем, иначе словарь копит запись на каждого, кто когда-либо нажимал;
+        # таймер нового нажатия, пришедшего до старта flush, остается на месте
+        timer = self.timers.get(user_id)
+        if timer is not None and timer.when() <= asyncio.get_running_loop().time():
+            del self.timers[user_id]
+        lock = self.locks.setdefault(user_id, asyncio.Lock())
+        async with lock:
+            desired = self.pending.pop(user_id, {})
+            refresh = self.refreshers.pop(user_id, None)
+            if not desired:
+                return
+            self.inflight[user_id] = desired
+            failed: List[str] = []
+            
+            try:
+                cached = user_autostocks_cache.pop(user_id, None)
+                user_items = await parser.db.load_user_autostocks(user_id)
+                if user_id not in user_autostocks_cache and cached is not None:
+                    # Supabase не ответил: прежний кэш лучше пустого набора
+                    user_autostocks_cache[user_id] = cached
+                    user_items = cached.copy()
+                known = user_id in user_autostocks_cache
+                
+                for item_name, tracked in desired.items():
+                    # Без известного состояния пишем всё: upsert и delete идемпотентны
+                    if known and tracked == (item_name in user_items):
+                        continue
+                    if tracked:
+                        success = await parser.db.save_user_autostock(user_id, item_name)
+                    else:
+                        success = await parser.db.remove_user_autostock(user_id, item_name)
+                    if not success:
+                        failed.append(item_name)
+                
+                if not known:
+                    # Частичный кэш из save_user_autostock не должен выдавать себя за полный
+                    user_autostocks_cache.pop(user_id, None)
+            except Exception as e:
+                logger.error(f"❌ Переключение {user_id}: {e}")
+                failed = list(desired)
+            finally:
+                self.inflight.pop(user_id, None)
+            
+            if refresh:
+                user_items = user_autostocks_cache.get(user_id)
+                try:
+                    await refresh(user_items.copy() if user_items is not None else None, failed)
+                except Exception as e:
+                    logger.warning(f"⚠️ Перерисовка {user_id}: {e}")
+        
+        if user_id not in self.pending and not lock.locked():
+            self.locks.pop(user_id, None)
+
+rate_limiter = UserRateLimiter()
+toggle_rate_limiter = UserRateLimiter(rate=TOGGLE_RATE_PER_SECOND, burst=TOGGLE_BURST)
+inline_rate_limiter = UserRateLimiter(rate=INLINE_RATE_PER_SECOND, burst=INLINE_BURST)
+toggle_coalescer = ToggleCoalescer()
+
+def toggle_item_id(update: Update) -> Optional[str]:
+    """ID предмета из кнопки переключения (t_/tr_) или None для остальных апдейтов."""
+    data = update.callback_query.data if update.callback_query else None
+    if not data:
+        return None
+    if data.startswith("tr_"):
+        return data[3:]
+    if data.startswith("t_"):
+        return data
+    return None
+
+async def throttle_updates(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Группа -1: срабатывает до всех хендлеров и обрывает обработку при превышении лимита."""
+    user = update.effective_user
+    if user is None:
+        return
+    
+    item_id = toggle_item_id(update)
+    if update.inline_query:
+        allowed = inline_rate_limiter.allow(user.id)
+    elif item_id is None:
+        allowed = rate_limiter.allow(user.id)
+    elif item_id not in ID_TO_NAME:
+        # Подделанные или устаревшие кнопки не должны тратить даже дешёвый лимит переключений
+        try:
+            await update.callback_query.answer("❌ Ошибка", show_alert=True)
+        except TelegramError:
+            pass
+        raise ApplicationHandlerStop
+    else:
+        # Переключения склеиваются ToggleCoalescer, поэтому у них отдельный, более щедрый bucket
+        allowed = toggle_rate_limiter.allow(user.id)
+    if allowed:
+        return
+    
+    try:
+        if update.callback_query:
+            await update.callback_query.answer("⏳ Слишком часто")
+        elif update.inline_query:
+            # Пустой ответ без кэша: следующий символ запроса получит настоящие результаты
+            await update.inline_query.answer([], cache_time=0)
+    except TelegramError:
+        pass
+    raise ApplicationHandlerStop
+
 # ========== КОМАНДЫ ==========
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.effective_message or not update.effective_user:
@@ -636,6 +2041,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     user = update.effective_user
     asyncio.create_task(parser.db.save_user(user.id, user.username, user.first_name))
+    asyncio.create_task(parser.reactivate_user(user.id))
     
     if not await check_subscription(context.bot, user.id):
         await update.effective_message.reply_text(
@@ -651,6 +2057,8 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "👗 /cosmetic - Косметика\n"
         "🌤️ /weather - Погода\n"
         "🔔 /autostock - Автостоки\n"
+        "🔎 /track - Найти и отслеживать предмет\n"
+        "⚙️ /filter - Фильтры автостока\n"
         "❓ /help - Справка",
         parse_mode=ParseMode.MARKDOWN
     )
@@ -668,7 +2076,7 @@ async def stock_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     stock_data = await discord_client.fetch_stock_data()
-    message = parser.format_stock_message(stock_data)
+    message = parser.render_stock_message(stock_data)
     await update.effective_message.reply_text(message, parse_mode=ParseMode.MARKDOWN)
 
 async def cosmetic_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -684,7 +2092,7 @@ async def cosmetic_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     cosmetics_data = await discord_client.fetch_cosmetics_data()
-    message = parser.format_cosmetics_message(cosmetics_data)
+    message = parser.render_cosmetics_message(cosmetics_data)
     await update.effective_message.reply_text(message, parse_mode=ParseMode.MARKDOWN)
 
 async def weather_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -723,6 +2131,143 @@ async def autostock_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode=ParseMode.MARKDOWN
     )
 
+def get_track_keyboard(item_names: List[str], user_items: Set[str]) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(
+            f"{'✅' if name in user_items else '➕'} {ITEM_LABELS.get(name, name)}",
+            callback_data=f"tr_{NAME_TO_ID[name]}"
+        )]
+        for name in item_names if name in NAME_TO_ID
+    ])
+
+async def track_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update.effective_message or not update.effective_user:
+        return
+    
+    if not await check_subscription(context.bot, update.effective_user.id):
+        await update.effective_message.reply_text("🔒 Подпишитесь на канал", reply_markup=get_subscription_keyboard())
+        return
+    
+    query = " ".join(context.args or [])
+    if not query:
+        await update.effective_message.reply_text("🔎 /track <название>, например /track zebra")
+        return
+    
+    user_id = update.effective_user.id
+    exact = item_search_index.resolve(query)
+    matches = [exact] if exact else item_search_index.search(query, TRACK_RESULTS_LIMIT)
+    if not matches:
+        await update.effective_message.reply_text("❌ Ничего не найдено")
+        return
+    
+    if len(matches) == 1:
+        item_name = matches[0]
+        user_items = await parser.db.load_user_autostocks(user_id)
+        if item_name in user_items:
+            text = f"ℹ️ *{item_name}* уже в автостоках\n{format_item_status(item_name)}"
+        elif await parser.db.save_user_autostock(user_id, item_name):
+            user_items = user_items | {item_name}
+            text = f"✅ *{item_name}* добавлен\n{format_item_status(item_name)}"
+        else:
+            await update.effective_message.reply_text("⚠️ Ошибка")
+            return
+        await update.effective_message.reply_text(text, reply_markup=get_track_keyboard(matches, user_items), parse_mode=ParseMode.MARKDOWN)
+        return
+    
+    user_items = await parser.db.load_user_autostocks(user_id)
+    lines = [f"{ITEM_LABELS.get(name, name)} — {format_item_status(name)}" for name in matches]
+    await update.effective_message.reply_text(
+        "🔎 *Найдено:*\n\n" + "\n".join(lines),
+        reply_markup=get_track_keyboard(matches, user_items),
+        parse_mode=ParseMode.MARKDOWN
+    )
+
+async def filter_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update.effective_message or not update.effective_user:
+        return
+    
+    if not await check_subscription(context.bot, update.effective_user.id):
+        await update.effective_message.reply_text("🔒 Подпишитесь на канал", reply_markup=get_subscription_keyboard())
+        return
+    
+    try:
+        query, filters = parse_filter_args(context.args or [])
+    except (ValueError, pytz.UnknownTimeZoneError):
+        query, filters = "", None
+    
+    if not query or filters is None:
+        await update.effective_message.reply_text(
+            "⚙️ *ФИЛЬТРЫ АВТОСТОКА*\n\n"
+            "/filter <предмет> min=5 quiet=23-8 tz=Europe/Moscow cooldown=30\n"
+            "/filter <предмет> off - сбросить\n"
+            "/filter <предмет> - показать",
+            parse_mode=ParseMode.MARKDOWN
+        )
+        return
+    
+    user_id = update.effective_user.id
+    item_name = item_search_index.resolve(query) or next(iter(item_search_index.search(query, 1)), None)
+    if not item_name or item_name not in await parser.db.load_user_autostocks(user_id):
+        await update.effective_message.reply_text("❌ Предмет не найден в ваших автостоках")
+        return
+    
+    if filters and not await parser.db.update_autostock_filters(user_id, item_name, filters):
+        await update.effective_message.reply_text("⚠️ Ошибка")
+        return
+    
+    current = await parser.db.get_autostock_filters(user_id, item_name) or {}
+    # Без Markdown: в названиях часовых поясов бывает '_'
+    await update.effective_message.reply_text(f"⚙️ {ITEM_LABELS.get(item_name, item_name)}\n\n{format_filters(current)}")
+
+async def inline_query_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.inline_query
+    if not query or not item_search_index:
+        return
+    
+    if query.query.strip():
+        matches = item_search_index.search(query.query)
+    else:
+        matches = [name for name in get_stock_quantities() if name in NAME_TO_ID][:SEARCH_RESULTS_LIMIT]
+    
+    results = []
+    for item_name in matches:
+        status = format_item_status(item_name)
+        results.append(InlineQueryResultArticle(
+            id=NAME_TO_ID[item_name],
+            title=ITEM_LABELS.get(item_name, item_name),
+            description=status,
+            input_message_content=InputTextMessageContent(
+                f"{ITEM_LABELS.get(item_name, item_name)}\n{status}\n\n🕒 {stock_snapshot_time or format_moscow_time()}"
+            ),
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔔 Автосток", callback_data=f"tr_{NAME_TO_ID[item_name]}")]])
+        ))
+    
+    await query.answer(results, cache_time=30)
+
+def get_category_keyboard(items_list: List[tuple], user_items: Set[str]) -> InlineKeyboardMarkup:
+    keyboard = []
+    for item_name, item_info in items_list:
+        status = "✅" if item_name in user_items else "➕"
+        keyboard.append([InlineKeyboardButton(
+            f"{status} {item_info['emoji']} {item_name}",
+            callback_data=NAME_TO_ID.get(item_name, "invalid")
+        )])
+    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="as_back")])
+    return InlineKeyboardMarkup(keyboard)
+
+async def report_toggle_failures(bot, user_id: int, failed: List[str]):
+    """Нажатие уже подтверждено через answer(), поэтому об ошибке записи сообщаем отдельно."""
+    if not failed:
+        return
+    try:
+        await bot.send_message(
+            chat_id=user_id,
+            text="⚠️ *Не удалось сохранить:* " + ", ".join(failed) + "\n\nПопробуйте ещё раз",
+            parse_mode=ParseMode.MARKDOWN
+        )
+    except TelegramError as e:
+        logger.warning(f"⚠️ Ошибка переключения {user_id}: {e}")
+
 async def autostock_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     if not update.effective_user:
@@ -755,17 +2300,8 @@ async def autostock_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
             else:
                 items_list, header = EGG_ITEMS_LIST, "🥚 *ЯЙЦА*"
             
-            keyboard = []
-            for item_name, item_info in items_list:
-                status = "✅" if item_name in user_items else "➕"
-                keyboard.append([InlineKeyboardButton(
-                    f"{status} {item_info['emoji']} {item_name}",
-                    callback_data=NAME_TO_ID.get(item_name, "invalid")
-                )])
-            keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="as_back")])
-            
             await query.answer()
-            await query.edit_message_text(header, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN)
+            await query.edit_message_text(header, reply_markup=get_category_keyboard(items_list, user_items), parse_mode=ParseMode.MARKDOWN)
         
         elif data == "as_list":
             user_items = await parser.db.load_user_autostocks(user_id)
@@ -774,8 +2310,7 @@ async def autostock_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
             else:
                 items_list = []
                 for item_name in sorted(user_items):
-                    item_info = ITEMS_DATA.get(item_name, {"emoji": "📦", "price": "?"})
-                    items_list.append(f"{item_info['emoji']} {item_name}")
+                    items_list.append(ITEM_LABELS.get(item_name) or f"📦 {item_name}")
                 message = f"📋 *МОИ АВТОСТОКИ*\n\n" + "\n".join(items_list)
             
             keyboard = [[InlineKeyboardButton("⬅️ Назад", callback_data="as_back")]]
@@ -799,27 +2334,6 @@ async def autostock_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 return
             
             category = ITEMS_DATA.get(item_name, {}).get('category', 'seed')
-            user_autostocks_cache.pop(user_id, None)
-            user_items = await parser.db.load_user_autostocks(user_id)
-            
-            if item_name in user_items:
-                success = await parser.db.remove_user_autostock(user_id, item_name)
-                if success:
-                    await query.answer(f"❌ {item_name} удален")
-                else:
-                    await query.answer("⚠️ Ошибка", show_alert=True)
-                    return
-            else:
-                success = await parser.db.save_user_autostock(user_id, item_name)
-                if success:
-                    await query.answer(f"✅ {item_name} добавлен")
-                else:
-                    await query.answer("⚠️ Ошибка", show_alert=True)
-                    return
-            
-            user_autostocks_cache.pop(user_id, None)
-            user_items = await parser.db.load_user_autostocks(user_id)
-            
             if category == 'seed':
                 items_list = SEED_ITEMS_LIST
             elif category == 'gear':
@@ -827,24 +2341,111 @@ async def autostock_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
             else:
                 items_list = EGG_ITEMS_LIST
             
-            keyboard = []
-            for name, info in items_list:
-                status = "✅" if name in user_items else "➕"
-                keyboard.append([InlineKeyboardButton(
-                    f"{status} {info['emoji']} {name}",
-                    callback_data=NAME_TO_ID.get(name, "invalid")
-                )])
-            keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="as_back")])
+            async def refresh(user_items: Optional[Set[str]], failed: List[str]):
+                await report_toggle_failures(context.bot, user_id, failed)
+                if user_items is not None:
+                    await query.edit_message_reply_markup(reply_markup=get_category_keyboard(items_list, user_items))
             
-            try:
-                await query.edit_message_reply_markup(reply_markup=InlineKeyboardMarkup(keyboard))
-            except:
-                pass
+            # Запись в базу и перерисовка клавиатуры - одним разом после серии нажатий
+            tracked = await toggle_coalescer.toggle(user_id, item_name, refresh)
+            await query.answer(f"✅ {item_name} добавлен" if tracked else f"❌ {item_name} удален")
+        
+        elif data.startswith("tr_"):
+            # Кнопки из /track и inline-режима: переключаем без перерисовки списка категории
+            item_name = ID_TO_NAME.get(data[3:])
+            if not item_name:
+                await query.answer("❌ Ошибка", show_alert=True)
+                return
+            
+            names = []
+            if query.message and query.message.reply_markup:
+                names = [ID_TO_NAME[row[0].callback_data[3:]] for row in query.message.reply_markup.inline_keyboard
+                         if row[0].callback_data and row[0].callback_data[3:] in ID_TO_NAME]
+            
+            async def refresh(user_items: Optional[Set[str]], failed: List[str]):
+                await report_toggle_failures(context.bot, user_id, failed)
+                if names and user_items is not None:
+                    await query.edit_message_reply_markup(reply_markup=get_track_keyboard(names, user_items))
+            
+            tracked = await toggle_coalescer.toggle(user_id, item_name, refresh)
+            await query.answer(f"✅ {item_name} добавлен" if tracked else f"❌ {item_name} удален")
     
     except Exception as e:
         logger.error(f"❌ Callback: {e}")
         await query.answer("⚠️ Ошибка", show_alert=True)
 
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update.effective_message or not update.effective_user:
+        return
+    
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    
+    args = context.args or []
+    if args and args[0] == "status":
+        if broadcast_manager.interrupted:
+            await update.effective_message.reply_text("⏸ Рассылка прервана: /broadcast resume | stop")
+            return
+        if not broadcast_manager.active:
+            await update.effective_message.reply_text("📣 Активной рассылки нет")
+            return
+        await update.effective_message.reply_text(broadcast_manager.format_progress(), parse_mode=ParseMode.MARKDOWN)
+        return
+    
+    if args and args[0] == "stop":
+        if broadcast_manager.stop():
+            await update.effective_message.reply_text("🛑 Рассылка остановлена")
+        elif broadcast_manager.discard():
+            await update.effective_message.reply_text("🗑 Прерванная рассылка отменена")
+        else:
+            await update.effective_message.reply_text("📣 Активной рассылки нет")
+        return
+    
+    if args and args[0] == "resume":
+        if broadcast_manager.resume(context.bot):
+            await update.effective_message.reply_text("▶️ Рассылка продолжена: /broadcast status")
+        elif broadcast_manager.active:
+            await update.effective_message.reply_text("⚠️ Рассылка уже идет: /broadcast status")
+        else:
+            await update.effective_message.reply_text("📣 Прерванной рассылки нет")
+        return
+    
+    text = update.effective_message.text.split(maxsplit=1)[1] if args else ""
+    if not text:
+        await update.effective_message.reply_text("📣 /broadcast <текст> | status | stop | resume")
+        return
+    
+    if broadcast_manager.active:
+        await update.effective_message.reply_text("⚠️ Рассылка уже идет: /broadcast status")
+        return
+    
+    if broadcast_manager.interrupted:
+        # Новая рассылка перезаписала бы чекпоинт, и часть пользователей осталась бы без старой
+        await update.effective_message.reply_text("⚠️ Есть прерванная рассылка: /broadcast resume или /broadcast stop")
+        return
+    
+    await broadcast_manager.start(context.bot, update.effective_chat.id, text)
+
+async def catalog_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update.effective_message or not update.effective_user:
+        return
+    
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    
+    if context.args and context.args[0] == "reload":
+        ok, details = await reload_catalog(f"команда {update.effective_user.id}")
+        await update.effective_message.reply_text(f"✅ Каталог перезагружен: {details}" if ok else f"❌ Каталог не изменен: {details}")
+        return
+    
+    lines = [f"📚 Каталог: {len(ITEMS_DATA)} предметов"]
+    if unknown_item_names:
+        lines.append("\n🆕 Кандидаты (неизвестные парсеру):")
+        for item_name, count in sorted(unknown_item_names.items(), key=lambda entry: -entry[1])[:20]:
+            lines.append(f"• {item_name} x{count}")
+    lines.append("\n/catalog reload - перечитать файл")
+    await update.effective_message.reply_text("\n".join(lines))
+
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.effective_message or not update.effective_user:
         return
@@ -859,6 +2460,8 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/cosmetic - Косметика\n"
         "/weather - Погода\n"
         "/autostock - Автостоки\n"
+        "/track - Найти предмет\n"
+        "/filter - Фильтры автостока\n"
         "/help - Справка\n\n"
         "⏰ Проверка автостоков: каждые 5 минут",
         parse_mode=ParseMode.MARKDOWN
@@ -887,7 +2490,14 @@ async def periodic_stock_check(application: Application):
                 
                 stock_data = await discord_client.fetch_stock_data()
                 if stock_data:
-                    await parser.check_user_autostocks(stock_data, application.bot)
+                    # Табло не ждет рассылку автостоков: его правка встает в очередь первой
+                    await asyncio.gather(
+                        live_board.update(application.bot, parser.render_stock_message(stock_data)),
+                        parser.check_user_autostocks(stock_data, application.bot)
+                    )
+                
+                if http_client.latency_stats:
+                    logger.info(f"📈 Supabase: {http_client.format_latency_stats()}")
                 
                 sleep_time = calculate_sleep_time()
                 await asyncio.sleep(sleep_time)
@@ -900,6 +2510,10 @@ async def periodic_stock_check(application: Application):
         pass
 
 async def post_init(application: Application):
+    send_pipeline.start()
+    await stock_api.start()
+    broadcast_manager.resume(application.bot)
+    asyncio.create_task(watch_catalog_file())
     asyncio.create_task(periodic_stock_check(application))
 
 # ========== MAIN ==========
@@ -908,7 +2522,9 @@ def main():
     logger.info("🌱 GAG Stock Tracker Bot v3.0 FINAL")
     logger.info("="*60)
 
-    build_item_id_mappings()
+    global catalog_mtime
+    catalog_mtime = os.path.getmtime(CATALOG_FILE)
+    apply_catalog(build_catalog(load_catalog_file(CATALOG_FILE)))
 
     global discord_client
     discord_client = StockDiscordClient()
@@ -916,13 +2532,19 @@ def main():
     global telegram_app
     telegram_app = Application.builder().token(BOT_TOKEN).build()
 
+    telegram_app.add_handler(TypeHandler(Update, throttle_updates), group=-1)
     telegram_app.add_handler(CommandHandler("start", start_command))
     telegram_app.add_handler(CommandHandler("stock", stock_command))
     telegram_app.add_handler(CommandHandler("cosmetic", cosmetic_command))
     telegram_app.add_handler(CommandHandler("weather", weather_command))
     telegram_app.add_handler(CommandHandler("autostock", autostock_command))
+    telegram_app.add_handler(CommandHandler("track", track_command))
+    telegram_app.add_handler(CommandHandler("filter", filter_command))
     telegram_app.add_handler(CommandHandler("help", help_command))
+    telegram_app.add_handler(CommandHandler("broadcast", broadcast_command))
+    telegram_app.add_handler(CommandHandler("catalog", catalog_command))
     telegram_app.add_handler(CallbackQueryHandler(autostock_callback))
+    telegram_app.add_handler(InlineQueryHandler(inline_query_handler))
 
     telegram_app.post_init = post_init
 
@@ -930,8 +2552,8 @@ def main():
         logger.info("🛑 Остановка")
         if discord_client:
             await discord_client.close()
-        if http_session and not http_session.closed:
-            await http_session.close()
+        await stock_api.stop()
+        await http_client.close()
 
     telegram_app.post_shutdown = shutdown_callback
 
@@ -944,6 +2566,8 @@ def main():
         logger.info("✅ Discord готов")
         
         await telegram_app.initialize()
+        # post_init/post_shutdown вызывает только run_polling, при ручном запуске зовем сами
+        await telegram_app.post_init(telegram_app)
         await telegram_app.start()
         await telegram_app.updater.start_polling(allowed_updates=None, drop_pending_updates=True)
         
@@ -958,6 +2582,7 @@ def main():
             await telegram_app.updater.stop()
             await telegram_app.stop()
             await telegram_app.shutdown()
+            await telegram_app.post_shutdown(telegram_app)
     
     try:
         asyncio.run(run_both())
@@ -0,0 +1,7 @@
+import os
+import sys
+
+os.environ.setdefault("BOT_TOKEN", "test-token")
+os.environ.setdefault("DISCORD_TOKEN", "test-token")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,49 @@
+import asyncio
+import os
+
+import bot
+
+
+class StubBot:
+    async def edit_message_text(self, **kwargs):
+        self.edited = kwargs["text"]
+
+
+class HangingDB:
+    async def iter_pages(self, *args, **kwargs):
+        await asyncio.Event().wait()
+        yield []
+
+
+def run_cancelled(monkeypatch, tmp_path, explicit_stop: bool):
+    monkeypatch.setattr(bot.parser, "db", HangingDB())
+    manager = bot.BroadcastManager(state_file=str(tmp_path / "broadcast.json"))
+    manager.state = {"text": "hi", "admin_chat_id": 1, "status_message_id": 2,
+                     "last_user_id": None, "sent": 0, "failed": 0, "total": None}
+    bot.save_json_state(manager.state_file, manager.state)
+    stub = StubBot()
+    
+    async def scenario():
+        manager.launch(stub)
+        await asyncio.sleep(0)
+        if explicit_stop:
+            manager.stop()
+        else:
+            # Так задачу отменяет asyncio.run при остановке бота
+            manager.task.cancel()
+        await asyncio.gather(manager.task, return_exceptions=True)
+    
+    asyncio.run(scenario())
+    return manager, stub
+
+
+def test_shutdown_keeps_checkpoint(monkeypatch, tmp_path):
+    manager, _ = run_cancelled(monkeypatch, tmp_path, explicit_stop=False)
+    assert os.path.exists(manager.state_file)
+    assert manager.interrupted
+
+
+def test_stop_clears_checkpoint_and_reports_stopped(monkeypatch, tmp_path):
+    manager, stub = run_cancelled(monkeypatch, tmp_path, explicit_stop=True)
+    assert not os.path.exists(manager.state_file)
+    assert stub.edited.startswith("🛑")
@@ -0,0 +1,32 @@
+import asyncio
+
+import bot
+
+
+class SubscribersDB:
+    async def iter_item_subscriptions(self, item_name, quantity=None, page_size=None):
+        yield [{"user_id": 1}, {"user_id": 2}]
+
+
+def test_stock_check_does_not_wait_for_paced_sends(monkeypatch, tmp_path):
+    monkeypatch.setattr(bot.parser, "db", SubscribersDB())
+    monkeypatch.setattr(bot, "dedup_ledger", bot.DedupLedger(path=str(tmp_path / "ledger.json")))
+    # Очередь не запущена: отправки не завершатся, пока их не разберет воркер
+    pipeline = bot.SendPipeline()
+    monkeypatch.setattr(bot, "send_pipeline", pipeline)
+    stock = {"seeds": [("Carrot", 3)], "gear": [], "eggs": []}
+    
+    async def scenario():
+        await asyncio.wait_for(bot.parser.check_user_autostocks(stock, bot=None), timeout=1)
+        await asyncio.sleep(0.01)
+        # Отправки еще в очереди, но ключ уже в журнале: рестарт не повторит рассылку
+        assert bot.dedup_ledger.notified
+        assert bot.parser.fan_out_tasks
+        # Повторная проверка того же стока не запускает вторую рассылку, пока идет первая
+        await bot.parser.check_user_autostocks(stock, bot=None)
+        assert len(bot.parser.fan_out_tasks) == 1
+        for task in list(bot.parser.fan_out_tasks):
+            task.cancel()
+        await asyncio.gather(*bot.parser.fan_out_tasks, return_exceptions=True)
+    
+    asyncio.run(scenario())
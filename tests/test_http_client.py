@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+
+import bot
+
+
+class FailingSession:
+    def __init__(self, error: BaseException):
+        self.error = error
+    
+    def request(self, *args, **kwargs):
+        raise self.error
+
+
+def open_breaker(client: bot.HTTPClient):
+    client.breaker.opened_at = 0.0
+
+
+def make_client(error: BaseException) -> bot.HTTPClient:
+    client = bot.HTTPClient()
+    client.breaker = bot.CircuitBreaker(failure_threshold=2, reset_timeout=0)
+    session = FailingSession(error)
+    
+    async def get_session():
+        return session
+    
+    client.get_session = get_session
+    return client
+
+
+def test_breaker_opens_after_threshold():
+    breaker = bot.CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+
+def test_half_open_allows_single_probe():
+    breaker = bot.CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    breaker.record_failure()
+    assert breaker.state == "half_open"
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.allow()
+
+
+def test_cancelled_probe_is_released():
+    client = make_client(asyncio.CancelledError())
+    open_breaker(client)
+    
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(client.request("POST", "http://supabase.test", "test"))
+    
+    assert client.breaker.state == "half_open"
+    assert client.breaker.allow()
+
+
+def test_unexpected_error_counts_as_failure():
+    client = make_client(ValueError("bad json"))
+    open_breaker(client)
+    
+    with pytest.raises(ValueError):
+        asyncio.run(client.request("POST", "http://supabase.test", "test"))
+    
+    assert not client.breaker.half_open_probe
+    assert client.latency_stats["test"]["errors"] == 1
+    # reset_timeout=0: после повторного открытия сразу доступна новая проба
+    assert client.breaker.allow()
@@ -0,0 +1,75 @@
+import asyncio
+
+from telegram.error import RetryAfter
+
+import bot
+
+
+class FloodedBot:
+    """Первая отправка получает flood control, следующие проходят."""
+    
+    def __init__(self):
+        self.calls = 0
+    
+    async def send_message(self, **kwargs):
+        self.calls += 1
+        if self.calls == 1:
+            raise RetryAfter(0)
+
+
+def test_retry_after_goes_back_through_pipeline(monkeypatch):
+    pipeline = bot.SendPipeline(rate_per_second=1000)
+    monkeypatch.setattr(bot, "send_pipeline", pipeline)
+    submitted = []
+    original_enqueue = pipeline.enqueue
+    
+    async def enqueue(send, priority=True):
+        submitted.append(priority)
+        return await original_enqueue(send, priority)
+    
+    pipeline.enqueue = enqueue
+    flooded = FloodedBot()
+    
+    async def scenario():
+        pipeline.start()
+        try:
+            return await pipeline.submit(lambda: bot.parser.deliver_message(flooded, 1, "hi", None, False), False)
+        finally:
+            pipeline.worker.cancel()
+    
+    assert asyncio.run(scenario()) == bot.DELIVERY_SENT
+    assert flooded.calls == 2
+    # Исходная задача и повтор - обе массовые, в обход очереди ничего не уходит
+    assert submitted == [False, False]
+
+
+class FloodedBoardBot:
+    def __init__(self):
+        self.edits = 0
+    
+    async def edit_message_text(self, **kwargs):
+        self.edits += 1
+        if self.edits == 1:
+            raise RetryAfter(0)
+
+
+def test_board_flood_control_pauses_pipeline(monkeypatch, tmp_path):
+    pipeline = bot.SendPipeline(rate_per_second=1000)
+    monkeypatch.setattr(bot, "send_pipeline", pipeline)
+    paused = []
+    monkeypatch.setattr(pipeline, "pause", paused.append)
+    board = bot.LiveBoard(["@board"], state_file=str(tmp_path / "board.json"))
+    board.boards["@board"] = {"message_id": 5, "hash": "old"}
+    flooded = FloodedBoardBot()
+    
+    async def scenario():
+        pipeline.start()
+        try:
+            await board.update(flooded, "stock")
+        finally:
+            pipeline.worker.cancel()
+    
+    asyncio.run(scenario())
+    assert paused == [0]
+    assert flooded.edits == 2
+    assert board.boards["@board"]["message_id"] == 5
@@ -0,0 +1,23 @@
+import asyncio
+
+import pytest
+
+import bot
+
+
+class RecordingClient:
+    def __init__(self):
+        self.calls = []
+    
+    async def request(self, method, url, endpoint, **kwargs):
+        self.calls.append((endpoint, kwargs.get("params")))
+        return bot.HTTPResult(204, None, {})
+
+
+@pytest.mark.parametrize("active, expected", [(False, "not.is.false"), (True, "is.false")])
+def test_autostock_status_filter_matches_readers(active, expected):
+    client = RecordingClient()
+    db = bot.SupabaseDB(client)
+    assert asyncio.run(db.set_autostocks_active(1, active))
+    # Читатели считают NULL активным, поэтому отключение обязано его захватывать
+    assert client.calls == [("autostocks.set_active", {"user_id": "eq.1", "is_active": expected})]
@@ -0,0 +1,37 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from telegram.ext import ApplicationHandlerStop
+
+import bot
+
+
+class InlineQuery:
+    def __init__(self):
+        self.answers = []
+    
+    async def answer(self, results, **kwargs):
+        self.answers.append(results)
+
+
+def inline_update(query: InlineQuery):
+    return SimpleNamespace(effective_user=SimpleNamespace(id=1), callback_query=None, inline_query=query)
+
+
+def test_inline_typing_is_not_cut_by_command_bucket(monkeypatch):
+    monkeypatch.setattr(bot, "rate_limiter", bot.UserRateLimiter(rate=0, burst=1))
+    monkeypatch.setattr(bot, "inline_rate_limiter", bot.UserRateLimiter(rate=0, burst=10))
+    query = InlineQuery()
+    # Набор "@bot master sprinkler" - запрос на каждую букву
+    for _ in range(10):
+        asyncio.run(bot.throttle_updates(inline_update(query), None))
+    assert query.answers == []
+
+
+def test_throttled_inline_query_gets_empty_answer(monkeypatch):
+    monkeypatch.setattr(bot, "inline_rate_limiter", bot.UserRateLimiter(rate=0, burst=0))
+    query = InlineQuery()
+    with pytest.raises(ApplicationHandlerStop):
+        asyncio.run(bot.throttle_updates(inline_update(query), None))
+    assert query.answers == [[]]
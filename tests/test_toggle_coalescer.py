@@ -0,0 +1,97 @@
+import asyncio
+
+import bot
+
+
+class FakeDB:
+    """Supabase в памяти; save/remove ждут gate, чтобы нажатие успело прийти во время flush."""
+    
+    def __init__(self, items=None, save_ok=True):
+        self.items = set(items or ())
+        self.save_ok = save_ok
+        self.gate = asyncio.Event()
+        self.gate.set()
+    
+    async def load_user_autostocks(self, user_id):
+        bot.user_autostocks_cache[user_id] = set(self.items)
+        return set(self.items)
+    
+    async def save_user_autostock(self, user_id, item_name):
+        await self.gate.wait()
+        if self.save_ok:
+            self.items.add(item_name)
+            bot.user_autostocks_cache.setdefault(user_id, set()).add(item_name)
+        return self.save_ok
+    
+    async def remove_user_autostock(self, user_id, item_name):
+        await self.gate.wait()
+        self.items.discard(item_name)
+        bot.user_autostocks_cache.get(user_id, set()).discard(item_name)
+        return True
+
+
+def run_with_db(monkeypatch, db, scenario):
+    monkeypatch.setattr(bot.parser, "db", db)
+    bot.user_autostocks_cache.clear()
+    return asyncio.run(scenario())
+
+
+def test_tap_during_flush_uses_inflight_state(monkeypatch):
+    db = FakeDB()
+    coalescer = bot.ToggleCoalescer(delay=60)
+    
+    async def refresh(user_items, failed):
+        pass
+    
+    async def scenario():
+        assert await coalescer.toggle(1, "Carrot", refresh) is True
+        coalescer.timers.pop(1).cancel()
+        db.gate.clear()
+        flush = asyncio.create_task(coalescer.flush(1))
+        await asyncio.sleep(0)
+        # Запись "Carrot" ещё не подтверждена базой - второе нажатие должно его снять
+        assert await coalescer.toggle(1, "Carrot", refresh) is False
+        coalescer.timers.pop(1).cancel()
+        db.gate.set()
+        await flush
+        await coalescer.flush(1)
+    
+    run_with_db(monkeypatch, db, scenario)
+    assert db.items == set()
+    assert not coalescer.locks
+
+
+def test_failed_write_is_reported(monkeypatch):
+    db = FakeDB(save_ok=False)
+    coalescer = bot.ToggleCoalescer(delay=60)
+    calls = []
+    
+    async def refresh(user_items, failed):
+        calls.append((user_items, failed))
+    
+    async def scenario():
+        await coalescer.toggle(1, "Carrot", refresh)
+        coalescer.timers.pop(1).cancel()
+        await coalescer.flush(1)
+    
+    run_with_db(monkeypatch, db, scenario)
+    assert calls == [(set(), ["Carrot"])]
+
+
+def test_fired_timer_is_released(monkeypatch):
+    db = FakeDB()
+    coalescer = bot.ToggleCoalescer(delay=0)
+    
+    async def refresh(user_items, failed):
+        pass
+    
+    async def wait_flushed():
+        while coalescer.timers or coalescer.locks or db.items != {"Carrot"}:
+            await asyncio.sleep(0.01)
+    
+    async def scenario():
+        await coalescer.toggle(1, "Carrot", refresh)
+        await asyncio.wait_for(wait_flushed(), timeout=1)
+    
+    run_with_db(monkeypatch, db, scenario)
+    assert db.items == {"Carrot"}